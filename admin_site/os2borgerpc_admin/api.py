@@ -13,12 +13,10 @@ from system.api import router as system_router
 # The header format is: "Authorizization: Bearer <SOME_API_KEY_HERE>"
 # Example curl call:
 # curl --header 'Authorization: Bearer <SOME_API_KEY_HERE>' http://os2borgerpc-admin.magenta.dk/api/system/pcs
+# On success the site of the key is available to the endpoints as request.auth
 class GlobalAuth(HttpBearer):
     def authenticate(self, request, key):
-        valid_key_check = APIKey.objects.filter(key=key).first()
-
-        if valid_key_check:
-            return valid_key_check.key
+        return APIKey.get_site(key)
 
 
 # Initialize, and require regular API key authentication to all endpoints except the docs endpoint, make docs endpoint
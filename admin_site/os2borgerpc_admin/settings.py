@@ -95,6 +95,30 @@ DATABASES = {
     }
 }
 
+# Cache setup
+# Defaults to a per-process memory cache. Point CACHE_BACKEND and CACHE_LOCATION
+# at a shared cache (e.g. memcached or redis) to share cached data between
+# gunicorn workers and management commands.
+CACHES = {
+    "default": {
+        "BACKEND": settings.get(
+            "CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"
+        ),
+        "LOCATION": settings.get("CACHE_LOCATION", ""),
+    }
+}
+
+# How old, in seconds, PC.last_seen may get before a client check-in writes it
+HEARTBEAT_FLUSH_INTERVAL = settings.getint("HEARTBEAT_FLUSH_INTERVAL", 60)
+
+# How long, in seconds, notifications to a recipient are collected before they
+# are sent together as one e-mail
+NOTIFICATION_DIGEST_WINDOW = settings.getint("NOTIFICATION_DIGEST_WINDOW", 60)
+
+# How old, in seconds, changes must be before the REST API lists them as
+# changed, so changes made by transactions not yet committed aren't skipped
+SYNC_SETTLE_PERIOD = settings.getint("SYNC_SETTLE_PERIOD", 30)
+
 # Hosts/domain names that are valid for this site; required if DEBUG is False
 # See https://docs.djangoproject.com/en/3.1/ref/settings/#allowed-hosts
 if settings.get("ALLOWED_HOSTS"):
@@ -260,6 +284,7 @@ XMLRPC_METHODS = (
     ("system.rpc.send_status_info", "send_status_info"),
     ("system.rpc.send_status_info_v2", "send_status_info_v2"),
     ("system.rpc.get_instructions", "get_instructions"),
+    ("system.rpc.get_instructions_v2", "get_instructions_v2"),
     ("system.rpc.push_config_keys", "push_config_keys"),
     ("system.rpc.push_security_events", "push_security_events"),
     ("system.rpc.citizen_login", "citizen_login"),
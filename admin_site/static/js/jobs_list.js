@@ -108,9 +108,13 @@ $(function(){
             if (data.has_previous) {
                 previous_item.removeClass("pagination-btn-muted");
                 previous_item.find('a').on("click", function() {
-                    var input = $('#jobsearch-filterform input[name=page]');
-                    input.val(data.previous_page_number);
-                    jobsearch.search();
+                    if (data.previous_cursor) {
+                        jobsearch.search(data.previous_cursor);
+                    } else {
+                        var input = $('#jobsearch-filterform input[name=page]');
+                        input.val(data.previous_page_number);
+                        jobsearch.search(null);
+                    }
                 });
             }
             previous_item.appendTo(pagination);
@@ -126,7 +130,7 @@ $(function(){
                 item.find('a').on("click", function() {
                     var input = $('#jobsearch-filterform input[name=page]');
                     input.val(page);
-                    jobsearch.search();
+                    jobsearch.search(null);
                 });
                 item.appendTo(pagination);
             });
@@ -136,9 +140,13 @@ $(function(){
             if (data.has_next) {
                 next_item.removeClass("disabled");
                 next_item.find('a').on("click", function() {
-                    var input = $('#jobsearch-filterform input[name=page]');
-                    input.val(data.next_page_number);
-                    jobsearch.search();
+                    if (data.next_cursor) {
+                        jobsearch.search(data.next_cursor);
+                    } else {
+                        var input = $('#jobsearch-filterform input[name=page]');
+                        input.val(data.next_page_number);
+                        jobsearch.search(null);
+                    }
                 });
             }
             next_item.appendTo(pagination);
@@ -148,13 +156,19 @@ $(function(){
             end_item.find('a').on("click", function() {
                 var input = $('#jobsearch-filterform input[name=page]');
                 input.val(data.num_pages);  // Set page to the last page
-                jobsearch.search();
+                jobsearch.search(null);
             });
             end_item.appendTo(pagination);
         },
-        search: function() {
+        // Fetches the page the cursor points to, by default the first page.
+        // With a null cursor, the page number in the form is used instead.
+        search: function(cursor) {
             var js = this
+            js.cursor = cursor === undefined ? '' : cursor
             js.searchConditions = $('#jobsearch-filterform').serialize()
+            if (js.cursor !== null) {
+                js.searchConditions += '&' + $.param({'cursor': js.cursor})
+            }
             $.ajax({
                 type: "GET",
                 url: js.searchUrl,
@@ -110,9 +110,13 @@ $(function(){
             if (data.has_previous) {
                 previous_item.removeClass("disabled")
                 previous_item.find('a').on("click", function() {
-                    var input = $('#securityeventsearch-filterform input[name=page]')
-                    input.val(data.previous_page_number)
-                    eventsearch.search()
+                    if (data.previous_cursor) {
+                        eventsearch.search(data.previous_cursor)
+                    } else {
+                        var input = $('#securityeventsearch-filterform input[name=page]')
+                        input.val(data.previous_page_number)
+                        eventsearch.search(null)
+                    }
                 })
             }
             previous_item.appendTo(pagination)
@@ -127,7 +131,7 @@ $(function(){
                 item.find('a').on("click", function() {
                     var input = $('#securityeventsearch-filterform input[name=page]')
                     input.val(page)
-                    eventsearch.search()
+                    eventsearch.search(null)
                 })
                 item.appendTo(pagination)
             })
@@ -136,16 +140,26 @@ $(function(){
             if (data.has_next) {
                 next_item.removeClass("disabled")
                 next_item.find('a').on("click", function() {
-                    var input = $('#securityeventsearch-filterform input[name=page]')
-                    input.val(data.next_page_number)
-                    eventsearch.search()
+                    if (data.next_cursor) {
+                        eventsearch.search(data.next_cursor)
+                    } else {
+                        var input = $('#securityeventsearch-filterform input[name=page]')
+                        input.val(data.next_page_number)
+                        eventsearch.search(null)
+                    }
                 })
             }
             next_item.appendTo(pagination)
         },
-        search: function() {
+        // Fetches the page the cursor points to, by default the first page.
+        // With a null cursor, the page number in the form is used instead.
+        search: function(cursor) {
             var js = this
+            js.cursor = cursor === undefined ? '' : cursor
             js.searchConditions = $('#securityeventsearch-filterform').serialize()
+            if (js.cursor !== null) {
+                js.searchConditions += '&' + $.param({'cursor': js.cursor})
+            }
 
             $.ajax({
                 type: "GET",
@@ -177,7 +191,8 @@ $(function(){
                 url: js.updateUrl,
                 data: $.param({'ids': event_ids, 'status': status, 'note':note, 'assigned_user':assigned_user}, true),
                 success: function() {
-                    js.search()
+                    // Reload the current page
+                    js.search(js.cursor)
                 }
             })
         },
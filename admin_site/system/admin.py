@@ -461,6 +461,14 @@ class LoginLogAdmin(admin.ModelAdmin):
         return qs.filter(site__in=request.user.user_profile.sites.all())
 
 
+@admin.register(m.Notification)
+class NotificationAdmin(admin.ModelAdmin):
+    list_display = ("recipient", "subject", "status", "created", "sent_time")
+    list_filter = ("status", ("created", admin.DateFieldListFilter))
+    search_fields = ("recipient", "subject")
+    readonly_fields = ("created", "sent_time", "error")
+
+
 @admin.register(m.PC)
 class PCAdmin(admin.ModelAdmin):
     list_display = (
@@ -1,23 +1,34 @@
+import base64
+import binascii
+import csv
+import json
 from datetime import date, datetime, timedelta
-from typing import List
-from django.db.models import Q
+from typing import Any, List, Literal, Optional
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.contrib.postgres.aggregates import StringAgg
+from django.db.models import CharField, F, Q, Value
+from django.db.models.functions import Cast, Coalesce, Concat
+from django.http import StreamingHttpResponse
 
 from ninja import Router
-from ninja.pagination import paginate
+from ninja.pagination import LimitOffsetPagination, paginate
 from ninja.errors import ValidationError
 
 
+from .login_statistics import get_login_statistics
 from .models import (
-    APIKey,
     Configuration,
     ConfigurationEntry,
     Job,
+    LoginCount,
     PC,
     SecurityEvent,
 )
 from .api_schemas import (
     ConfigurationEntrySchema,
     JobSchema,
+    LoginStatisticsSchema,
     PCSchema,
     PCLoginsSchema,
     SecurityEventSchema,
@@ -40,38 +51,141 @@ router = Router()
 
 
 def get_site_from_request(request):
-    """Obtains the site based on the API Key, from the request headers"""
-    key = request.headers["Authorization"].split(" ")[-1]
-    valid_key_check = APIKey.objects.filter(key=key).first()
+    """Obtains the site of the API Key, as resolved by the authentication"""
+    return request.auth
 
-    if valid_key_check:
-        return valid_key_check.site
+
+# Rows fetched per round trip through the server side cursor of an export
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_CONTENT_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+class Echo:
+    """A file-like object that returns what is written to it, so the rows
+    produced by csv.writer can be streamed."""
+
+    def write(self, value):
+        return value
+
+
+def export_rows(queryset, schema, export_format):
+    """Serialize the fields of the schema, one line at a time, without loading
+    the whole queryset into memory.
+
+    The rows are fetched as dicts rather than model instances, as creating
+    those dominates the time spent on large exports. Fields the schema
+    resolves from related objects must be annotated on the queryset."""
+    fields = list(schema.__fields__)
+    rows = queryset.values(*fields).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    if export_format == "csv":
+        writer = csv.DictWriter(Echo(), fieldnames=fields)
+        yield writer.writeheader()
+        for row in rows:
+            yield writer.writerow(row)
+    else:
+        for row in rows:
+            yield json.dumps(row, cls=DjangoJSONEncoder) + "\n"
+
+
+def export_response(queryset, schema, export_format, name):
+    response = StreamingHttpResponse(
+        export_rows(queryset, schema, export_format),
+        content_type=EXPORT_CONTENT_TYPES[export_format],
+    )
+    response["Content-Disposition"] = f'attachment; filename="{name}.{export_format}"'
+    return response
 
 
 def validate_sensible_dates(from_date, to_date):
-    if from_date > to_date:
+    if from_date and to_date and from_date > to_date:
         raise ValidationError("from_date is after to_date")
-    elif to_date > date.today():
+    elif to_date and to_date > date.today():
         raise ValidationError("to_date is in the future")
 
 
-def filter_logins(all_logins, from_date, to_date):
-    # Turn the string into a python list of tuples with any spaces removed
-    # In other words it'll look like this:
-    # [('2023-10-10', '4'), ('2023-10-11', '4'), ('2023-10-12', '3'), ('2023-10-16', '0')]
-    all_logins_parsed = [
-        tuple(x.replace(" ", "").split(":")) for x in all_logins.split(",")
-    ]
+# Incremental sync
+# Objects changed since a given time are listed in the order they were
+# modified. Each page carries a cursor pointing after its last object, which
+# is passed on to fetch the next page, or saved to continue from on the next
+# sync. Deleted objects are not reported.
+# The modified timestamp is set before the change is committed, so a change
+# can become visible after later changes have already been listed. Changes
+# are therefore only listed once they are SYNC_SETTLE_PERIOD seconds old, by
+# which time their transactions have committed, and the cursor never moves
+# past a change that could still appear before it.
 
-    # Further turn the above into the format [(date, string)]
-    all_logins_parsed = [
-        (datetime.strptime(login[0], "%Y-%m-%d").date(), login[1])
-        for login in all_logins_parsed
-    ]
-    return ", ".join(
-        f"{date}: {logins}"
-        for date, logins in all_logins_parsed
-        if from_date <= date <= to_date
+
+def encode_cursor(obj):
+    value = json.dumps([obj.modified.isoformat(), obj.pk])
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        modified, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(modified), int(pk)
+    except (binascii.Error, TypeError, ValueError):
+        raise ValidationError("Invalid cursor")
+
+
+def filter_changed(queryset, updated_since=None, cursor=None):
+    """Return the objects of the queryset modified at or after updated_since,
+    or after the object the cursor points to, in the order they were
+    modified. Changes more recent than SYNC_SETTLE_PERIOD are left out."""
+    queryset = queryset.filter(
+        modified__lt=datetime.now() - timedelta(seconds=settings.SYNC_SETTLE_PERIOD)
+    )
+    if cursor:
+        modified, pk = decode_cursor(cursor)
+        queryset = queryset.filter(
+            Q(modified__gt=modified) | Q(modified=modified, pk__gt=pk)
+        )
+    elif updated_since:
+        queryset = queryset.filter(modified__gte=updated_since)
+    return queryset.order_by("modified", "pk")
+
+
+class ChangesPagination(LimitOffsetPagination):
+    """Limit/offset pagination, which also returns a cursor for continuing
+    after the last object when listing changes."""
+
+    class Output(LimitOffsetPagination.Output):
+        next_cursor: Optional[str] = None
+
+    def paginate_queryset(self, queryset, pagination, **params: Any):
+        result = super().paginate_queryset(queryset, pagination, **params)
+        if params.get("updated_since") or params.get("cursor"):
+            items = list(result["items"])
+            result["items"] = items
+            result["next_cursor"] = (
+                encode_cursor(items[-1]) if items else params.get("cursor")
+            )
+        return result
+
+
+def get_logins_per_day(pcs, from_date, to_date):
+    """Return the names of the PCs with logins and their logins per day, as
+    strings like "2023-10-10: 4, 2023-10-11: 2", in a single query."""
+    login_counts = LoginCount.objects.filter(pc__in=pcs)
+    # both set or either set: filter, neither set: don't filter
+    if from_date != date(1970, 1, 1) or to_date != date.today():
+        validate_sensible_dates(from_date, to_date)
+        login_counts = login_counts.filter(date__range=[from_date, to_date])
+    return (
+        login_counts.order_by("pc__name", "pc")
+        .values("pc__name", "pc")
+        .annotate(
+            logins_per_day=StringAgg(
+                Concat(
+                    Cast("date", CharField()),
+                    Value(": "),
+                    Cast("count", CharField()),
+                ),
+                ", ",
+                ordering="date",
+            )
+        )
+        .values_list("pc__name", "logins_per_day")
     )
 
 
@@ -80,7 +194,7 @@ def filter_logins(all_logins, from_date, to_date):
     "/computers",
     response=List[PCSchema],
     url_name="computers",
-    description="Fetch list of all Computers.",
+    description="Fetch list of all Computers. To only fetch the Computers changed since the last sync, use the computers/changes endpoint.",
 )
 def list_pcs(request):
     site = get_site_from_request(request)
@@ -89,6 +203,20 @@ def list_pcs(request):
     return pcs or []
 
 
+# Kept apart from the computers endpoint, which returns a plain list rather
+# than pages, so existing clients of it are unaffected.
+@router.get(
+    "/computers/changes",
+    response=List[PCSchema],
+    url_name="computers-changes",
+    description="Fetch the Computers changed since updated_since, or since the next_cursor of the last page passed as cursor, in the order they were changed. Changes are listed once they are 30 seconds old by default, so none are missed by continuing from the cursor.",
+)
+@paginate(ChangesPagination)
+def list_changed_pcs(request, updated_since: datetime = None, cursor: str = None):
+    site = get_site_from_request(request)
+    return filter_changed(PC.objects.filter(site=site), updated_since, cursor)
+
+
 # Events
 # If no from_date: Default to three months ago, if no to_date, assume today.
 @router.get(
@@ -96,12 +224,14 @@ def list_pcs(request):
     response=List[SecurityEventSchema],
     url_name="events",
 )
-@paginate
+@paginate(ChangesPagination)
 def list_events(
     request,
-    from_date: date = date.today() - timedelta(days=90),
-    to_date: date = date.today(),
-    status=SecurityEvent.NEW,
+    from_date: date = None,
+    to_date: date = None,
+    status: str = None,
+    updated_since: datetime = None,
+    cursor: str = None,
 ):
     """
     Fetches events (Security Events and Offline Events).
@@ -109,20 +239,76 @@ def list_events(
      - **status**: New
        - Other options available, which you can pass along in the request to get different results:
        - Status: New, Assigned, Resolved
+
+    To only fetch the events changed since the last sync, pass **updated_since**
+    or the **next_cursor** of the last page as **cursor**. The events are then
+    returned in the order they were changed, with any status and date, unless
+    those are given. Changes are listed once they are 30 seconds old by default,
+    so none are missed by continuing from the cursor.
     """
-    validate_sensible_dates(from_date, to_date)
     site = get_site_from_request(request)
+    return filter_events(
+        site, from_date, to_date, status, updated_since, cursor
+    ).select_related("pc", "problem", "event_rule_server")
+
+
+@router.get(
+    "/events/export",
+    url_name="events-export",
+    description="Export all events matching the same filters as the events endpoint in a single response, as newline delimited JSON or CSV.",
+)
+def export_events(
+    request,
+    from_date: date = None,
+    to_date: date = None,
+    status: str = None,
+    updated_since: datetime = None,
+    cursor: str = None,
+    format: Literal["ndjson", "csv"] = "ndjson",
+):
+    site = get_site_from_request(request)
+    events = filter_events(
+        site, from_date, to_date, status, updated_since, cursor
+    ).annotate(
+        monitoring_rule=Coalesce("problem__name", "event_rule_server__name"),
+        level=Coalesce("problem__level", "event_rule_server__level"),
+        pc_name=F("pc__name"),
+    )
+    return export_response(events, SecurityEventSchema, format, "events")
+
+
+def filter_events(
+    site, from_date=None, to_date=None, status=None, updated_since=None, cursor=None
+):
+    """Return the site's events matching the filters of the events endpoints.
+
+    Unless only the changed events are requested, the events with status New
+    from the last three months are returned by default."""
+    if not (updated_since or cursor):
+        from_date = from_date or date.today() - timedelta(days=90)
+        to_date = to_date or date.today()
+        status = status or SecurityEvent.NEW
+    validate_sensible_dates(from_date, to_date)
+    events = get_site_events(site, from_date, to_date, status)
+    if updated_since or cursor:
+        events = filter_changed(events, updated_since, cursor)
+    return events
+
+
+def get_site_events(site, from_date=None, to_date=None, status=None):
     # Do we filter on do occurred_time, reported_time or created? Or multiple of them? Maybe occurred?
     events = SecurityEvent.objects.filter(
-        (Q(problem__site=site) | Q(event_rule_server__site=site)),
-        occurred_time__range=[
-            from_date,
-            to_date + timedelta(days=1),
-        ],  # +1 to include the full to_date
-        status=status.upper(),
+        (Q(problem__site=site) | Q(event_rule_server__site=site))
     ).order_by(
         "-id"
     )  # or -occurred_time, but ID is probably faster
+    if from_date:
+        events = events.filter(occurred_time__gte=from_date)
+    if to_date:
+        # +1 to include the full to_date
+        events = events.filter(occurred_time__lte=to_date + timedelta(days=1))
+    if status:
+        events = events.filter(status=status.upper())
     return events
 
 
@@ -162,16 +348,10 @@ def get_pcs_logins_per_day(
 ):
     site = get_site_from_request(request)
     pcs = PC.objects.filter(site=site, is_activated=True)
-    pc_names_with_logins = []
-    for pc in pcs:
-        logins = pc.get_config_value("login_counts")
-        # both set or either set: filter, neither set: don't filter
-        if from_date != date(1970, 1, 1) or to_date != date.today():
-            validate_sensible_dates(from_date, to_date)
-            if logins:
-                logins = filter_logins(logins, from_date, to_date)
-        if logins:
-            pc_names_with_logins.append({"pc_name": pc.name, "logins_per_day": logins})
+    pc_names_with_logins = [
+        {"pc_name": pc_name, "logins_per_day": logins}
+        for pc_name, logins in get_logins_per_day(pcs, from_date, to_date)
+    ]
 
     if pc_names_with_logins:
         return 200, pc_names_with_logins
@@ -195,16 +375,11 @@ def get_pc_logins_per_day(
     site = get_site_from_request(request)
     try:
         pc = PC.objects.get(site=site, id=pc_id)
-        logins = pc.get_config_value("login_counts")
+        logins = get_logins_per_day([pc], from_date, to_date)
     except PC.DoesNotExist:
         pc = None
     if pc and logins:
-        # both set or either set: filter, neither set: don't filter
-        if from_date != date(1970, 1, 1) or to_date != date.today():
-            validate_sensible_dates(from_date, to_date)
-            logins = filter_logins(logins, from_date, to_date)
-
-        return 200, {"pc_name": pc.name, "logins_per_day": logins}
+        return 200, {"pc_name": pc.name, "logins_per_day": logins[0][1]}
     elif pc:
         return 200, {"pc_name": pc.name, "logins_per_day": ""}
     else:
@@ -213,32 +388,93 @@ def get_pc_logins_per_day(
         # return 204, (None, None)
 
 
+# Login statistics for the whole site, per day and per group
+@router.get(
+    "/logins/statistics",
+    response=LoginStatisticsSchema,
+    url_name="logins-statistics",
+    description="Fetch the number of logins per day and per Computer Group in a period of up to a year, by default the last 30 days. Logins are the logins on all Computers, as they report them, whereas citizen logins are the logins of citizens logging in through the admin portal.",
+)
+def get_logins_statistics(
+    request,
+    from_date: date = None,
+    to_date: date = None,
+):
+    to_date = to_date or date.today()
+    from_date = from_date or to_date - timedelta(days=29)
+    validate_sensible_dates(from_date, to_date)
+    if (to_date - from_date).days >= 366:
+        raise ValidationError("The period is longer than a year")
+    site = get_site_from_request(request)
+    return get_login_statistics(site, from_date, to_date)
+
+
 # Jobs
 @router.get(
     "/jobs",
     response=List[JobSchema],
     url_name="jobs",
-    description="Fetch a list of all Jobs.",
+    description="Fetch a list of all Jobs created in the last three months, by default. To only fetch the Jobs changed since the last sync, pass updated_since or the next_cursor of the last page as cursor. The Jobs are then returned in the order they were changed, no matter when they were created, unless the dates are given. Changes are listed once they are 30 seconds old by default, so none are missed by continuing from the cursor.",
 )
-@paginate
+@paginate(ChangesPagination)
 def get_jobs(
     request,
-    from_date: date = date.today() - timedelta(days=90),
-    to_date: date = date.today(),
+    from_date: date = None,
+    to_date: date = None,
+    updated_since: datetime = None,
+    cursor: str = None,
 ):
-    validate_sensible_dates(from_date, to_date)
     site = get_site_from_request(request)
-    jobs = Job.objects.filter(
-        batch__site=site,
-        created__range=[
-            from_date,
-            to_date + timedelta(days=1),
-        ],  # +1 to include the full to_date
-    ).order_by(
+    return filter_jobs(site, from_date, to_date, updated_since, cursor).select_related(
+        "pc"
+    )
+
+
+@router.get(
+    "/jobs/export",
+    url_name="jobs-export",
+    description="Export all Jobs matching the same filters as the jobs endpoint in a single response, as newline delimited JSON or CSV.",
+)
+def export_jobs(
+    request,
+    from_date: date = None,
+    to_date: date = None,
+    updated_since: datetime = None,
+    cursor: str = None,
+    format: Literal["ndjson", "csv"] = "ndjson",
+):
+    site = get_site_from_request(request)
+    jobs = filter_jobs(site, from_date, to_date, updated_since, cursor).annotate(
+        pc_name=F("pc__name")
+    )
+    return export_response(jobs, JobSchema, format, "jobs")
+
+
+def filter_jobs(site, from_date=None, to_date=None, updated_since=None, cursor=None):
+    """Return the site's Jobs matching the filters of the jobs endpoints.
+
+    Unless only the changed Jobs are requested, the Jobs from the last three
+    months are returned by default."""
+    if not (updated_since or cursor):
+        from_date = from_date or date.today() - timedelta(days=90)
+        to_date = to_date or date.today()
+    validate_sensible_dates(from_date, to_date)
+    jobs = get_site_jobs(site, from_date, to_date)
+    if updated_since or cursor:
+        jobs = filter_changed(jobs, updated_since, cursor)
+    return jobs
+
+
+def get_site_jobs(site, from_date=None, to_date=None):
+    jobs = Job.objects.filter(batch__site=site).order_by(
         "-id"
     )  # or -created, but ID is probably faster
-
-    return jobs or []
+    if from_date:
+        jobs = jobs.filter(created__gte=from_date)
+    if to_date:
+        # +1 to include the full to_date
+        jobs = jobs.filter(created__lte=to_date + timedelta(days=1))
+    return jobs
 
 
 # Individual endpoints moved down here for now, as they may not be needed:
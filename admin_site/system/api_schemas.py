@@ -1,3 +1,6 @@
+from datetime import date
+from typing import List
+
 from .models import ConfigurationEntry, Job, PC, SecurityEvent
 from ninja import ModelSchema, Schema
 from ninja.orm import create_schema
@@ -30,6 +33,7 @@ class PCSchema(ModelSchema):
             "last_seen",
             "is_activated",
             "created",
+            "modified",
             "pc_groups",
             "configuration",
         ]
@@ -69,6 +73,7 @@ class SecurityEventSchema(ModelSchema):
             "status",
             "assigned_user",
             "note",
+            "modified",
         ]
 
 
@@ -87,9 +92,38 @@ class JobSchema(ModelSchema):
 
     class Config:
         model = Job
-        model_fields = ["id", "status", "created", "started", "finished", "pc"]
+        model_fields = [
+            "id",
+            "status",
+            "created",
+            "modified",
+            "started",
+            "finished",
+            "pc",
+        ]
 
 
 class PCLoginsSchema(Schema):
     pc_name: str
     logins_per_day: str
+
+
+class DayLoginsSchema(Schema):
+    date: date
+    logins: int
+    citizen_logins: int
+
+
+class GroupLoginsSchema(Schema):
+    id: int
+    name: str
+    logins: int
+
+
+class LoginStatisticsSchema(Schema):
+    from_date: date
+    to_date: date
+    logins: int
+    citizen_logins: int
+    days: List[DayLoginsSchema]
+    groups: List[GroupLoginsSchema]
@@ -1,3 +1,5 @@
+from datetime import datetime
+
 from django import forms
 from django.forms import ValidationError
 from django.contrib.auth.models import User
@@ -103,9 +105,15 @@ class PCGroupForm(forms.ModelForm):
 
         def save_m2m():
             old_save_m2m()
+            members_pre = set(instance.pcs.values_list("pk", flat=True))
             instance.pcs.clear()
             for pc in self.cleaned_data["pcs"]:
                 instance.pcs.add(pc)
+            # Changed memberships are modifications of the PCs
+            members_post = {pc.pk for pc in self.cleaned_data["pcs"]}
+            PC.objects.filter(pk__in=members_pre ^ members_post).update(
+                modified=datetime.now()
+            )
 
         self.save_m2m = save_m2m
 
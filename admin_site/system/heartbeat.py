@@ -0,0 +1,70 @@
+"""Write coalescing for client check-ins.
+
+Every call to the client API marks the PC as seen. Instead of saving the PC
+row on each call, PC.last_seen is only written when the stored value is
+older than HEARTBEAT_FLUSH_INTERVAL seconds, so PC.last_seen lags at most
+that long behind the PC's latest check-in. The exact timestamp is kept in the
+cache in the meantime.
+
+Code that needs an up to date "last seen" value should use last_seen() or
+last_seen_many() instead of reading PC.last_seen directly."""
+
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Value
+from django.db.models.functions import Greatest
+
+# Cached timestamps only need to outlive the flush interval, but are kept for
+# a day so they are still around if the interval is raised.
+CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def _cache_key(pc_id):
+    return f"pc_last_seen:{pc_id}"
+
+
+def is_write_due(stored, when):
+    return stored is None or when - stored >= timedelta(
+        seconds=settings.HEARTBEAT_FLUSH_INTERVAL
+    )
+
+
+def record(pc, when=None):
+    """Register that the PC has checked in, writing PC.last_seen if the
+    stored value is older than the flush interval.
+
+    Returns whether PC.last_seen was written."""
+    from system.models import PC
+
+    if when is None:
+        when = datetime.now()
+    write_due = is_write_due(pc.last_seen, when)
+    pc.last_seen = when
+    cache.set(_cache_key(pc.pk), when, CACHE_TIMEOUT)
+
+    if write_due:
+        # Greatest() makes sure a concurrent check-in can never move
+        # last_seen backwards.
+        PC.objects.filter(pk=pc.pk).update(last_seen=Greatest("last_seen", Value(when)))
+    return write_due
+
+
+def _newest(stored, cached):
+    if stored is None or (cached is not None and cached > stored):
+        return cached
+    return stored
+
+
+def last_seen(pc):
+    """Return when the PC was last seen, including unwritten check-ins."""
+    return _newest(pc.last_seen, cache.get(_cache_key(pc.pk)))
+
+
+def last_seen_many(pcs):
+    """Return a dict mapping PC ids to when the PC was last seen, including
+    unwritten check-ins, using a single cache lookup."""
+    pcs = list(pcs)
+    cached = cache.get_many([_cache_key(pc.pk) for pc in pcs])
+    return {pc.pk: _newest(pc.last_seen, cached.get(_cache_key(pc.pk))) for pc in pcs}
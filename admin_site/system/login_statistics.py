@@ -0,0 +1,143 @@
+"""Login statistics of a site, aggregated per day and per group.
+
+The logins are counted from the login counts pushed by the PCs, see
+LoginCount, and the citizen logins from the LoginLog. The totals of each
+day are computed in the database.
+
+Clients report the logins of a day until the next day, after which the
+day is considered closed. The totals of closed days rarely change, so they
+are cached, and only the days missing from the cache are aggregated. They
+are cached per site and month, to keep the number of cache entries down.
+
+A PC may still report a closed day late, e.g. after being offline, and the
+groups of the PCs may change. Either increments the site's
+login_statistics_version, which is part of the cache keys. The version is
+kept in the database rather than the cache, so it is shared by all
+processes even when the cache is not."""
+
+from collections import defaultdict
+from datetime import date, timedelta
+
+from django.core.cache import cache
+from django.db.models import Count, F, Sum
+
+from system.models import LoginCount, LoginLog, PCGroup, Site
+
+CACHE_TIMEOUT = 60 * 60 * 24 * 30
+
+
+def get_cache_key(site_id, day, version):
+    return f"login_statistics:{site_id}:{version}:{day.year}-{day.month}"
+
+
+def invalidate(sites):
+    """Make the cached totals of the sites in the queryset stale."""
+    sites.update(login_statistics_version=F("login_statistics_version") + 1)
+
+
+def is_closed(day, today=None):
+    if today is None:
+        today = date.today()
+    return day < today - timedelta(days=1)
+
+
+def aggregate_days(site, days):
+    """Return a dict mapping each of the days to its totals, computed in
+    three queries regardless of the number of days."""
+    totals = {day: {"logins": 0, "citizen_logins": 0, "groups": {}} for day in days}
+
+    login_counts = LoginCount.objects.filter(pc__site=site, date__in=days).order_by()
+    for day, logins in (
+        login_counts.values("date")
+        .annotate(logins=Sum("count"))
+        .values_list("date", "logins")
+    ):
+        totals[day]["logins"] = logins
+    for day, group_id, logins in (
+        login_counts.filter(pc__pc_groups__isnull=False)
+        .values("date", "pc__pc_groups")
+        .annotate(logins=Sum("count"))
+        .values_list("date", "pc__pc_groups", "logins")
+    ):
+        totals[day]["groups"][group_id] = logins
+
+    for day, citizen_logins in (
+        LoginLog.objects.filter(site=site, date__in=days)
+        .order_by()
+        .values("date")
+        .annotate(citizen_logins=Count("pk"))
+        .values_list("date", "citizen_logins")
+    ):
+        totals[day]["citizen_logins"] = citizen_logins
+
+    return totals
+
+
+def get_daily_totals(site, days):
+    """Return a dict mapping each of the days to its totals, reusing the
+    cached totals of closed days."""
+    closed_days = [day for day in days if is_closed(day)]
+    # Read from the database, as the site object itself may be cached
+    version = Site.objects.values_list("login_statistics_version", flat=True).get(
+        pk=site.pk
+    )
+    cached = cache.get_many(
+        {get_cache_key(site.pk, day, version) for day in closed_days}
+    )
+    totals = {}
+    for day in closed_days:
+        month_totals = cached.get(get_cache_key(site.pk, day, version), {})
+        if day in month_totals:
+            totals[day] = month_totals[day]
+
+    missing = [day for day in days if day not in totals]
+    if missing:
+        aggregated = aggregate_days(site, missing)
+        totals.update(aggregated)
+
+        updated = {}
+        for day, day_totals in aggregated.items():
+            if is_closed(day):
+                cache_key = get_cache_key(site.pk, day, version)
+                month_totals = updated.setdefault(cache_key, cached.get(cache_key, {}))
+                month_totals[day] = day_totals
+        cache.set_many(updated, CACHE_TIMEOUT)
+    return totals
+
+
+def get_login_statistics(site, from_date, to_date):
+    """Return the logins of the site in the period, in total, per day and per
+    group."""
+    days = [
+        from_date + timedelta(days=offset)
+        for offset in range((to_date - from_date).days + 1)
+    ]
+    daily_totals = get_daily_totals(site, days)
+
+    group_logins = defaultdict(int)
+    for day_totals in daily_totals.values():
+        for group_id, logins in day_totals["groups"].items():
+            group_logins[group_id] += logins
+
+    return {
+        "from_date": from_date,
+        "to_date": to_date,
+        "logins": sum(totals["logins"] for totals in daily_totals.values()),
+        "citizen_logins": sum(
+            totals["citizen_logins"] for totals in daily_totals.values()
+        ),
+        "days": [
+            {
+                "date": day,
+                "logins": daily_totals[day]["logins"],
+                "citizen_logins": daily_totals[day]["citizen_logins"],
+            }
+            for day in days
+        ],
+        "groups": [
+            {"id": group_id, "name": name, "logins": group_logins[group_id]}
+            for group_id, name in PCGroup.objects.filter(site=site)
+            .order_by("name")
+            .values_list("pk", "name")
+        ],
+    }
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from system.notifications import dispatch_notifications
+
+
+class Command(BaseCommand):
+    help = "Send the pending notifications in per-recipient digests"
+
+    def handle(self, *args, **options):
+        """Send the notifications that have waited for the digest window, so
+        security events are e-mailed without the notification worker"""
+
+        sent = dispatch_notifications()
+        if sent:
+            self.stdout.write(f"Sent {sent} notification e-mails")
@@ -0,0 +1,82 @@
+import time
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count, Q
+from system.models import EventRuleServer, Job, SecurityEvent, Site
+
+
+class Command(BaseCommand):
+    """
+    Show the query plans and timings of the most frequent job, event and
+    configuration queries, to check that they use the intended indexes.
+
+    Run it before and after changing indexes to compare the plans.
+
+    Form:
+            $ python manage.py explain_hot_queries [--site <site_uid>] [--repeat <n>]
+    """
+
+    help = "Show query plans and timings for the hot job, event and config queries"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--site",
+            help="UID of the site to query, defaults to the site with most PCs",
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=10,
+            help="Number of times to run each query when timing it",
+        )
+
+    def get_queries(self, site):
+        pc = site.pcs.annotate(job_count=Count("jobs")).order_by("-job_count").first()
+        if pc is None:
+            raise CommandError(f"The site {site.uid} has no PCs")
+        rule = EventRuleServer.objects.filter(site=site).first()
+        now = datetime.now()
+        from_date = now - timedelta(days=90)
+
+        queries = {
+            "Configuration of a PC": pc.get_config_entries(),
+            "Outstanding jobs of a PC": Job.objects.filter(pc=pc, status=Job.NEW),
+            "Jobs of a site (get_jobs)": Job.objects.filter(
+                batch__site=site, created__range=[from_date, now]
+            ).order_by("-id")[:100],
+            "Events of a site (list_events)": SecurityEvent.objects.filter(
+                Q(problem__site=site) | Q(event_rule_server__site=site),
+                occurred_time__range=[from_date, now],
+                status=SecurityEvent.NEW,
+            ).order_by("-id")[:100],
+        }
+        if rule:
+            queries["Offline events of a PC (check_notifications)"] = (
+                SecurityEvent.objects.filter(
+                    pc=pc, event_rule_server=rule, reported_time__gte=from_date
+                )
+            )
+        return queries
+
+    def handle(self, *args, **options):
+        if options["site"]:
+            site = Site.objects.filter(uid=options["site"]).first()
+        else:
+            site = (
+                Site.objects.annotate(pc_count=Count("pcs"))
+                .order_by("-pc_count")
+                .first()
+            )
+        if site is None:
+            raise CommandError("No such site")
+
+        for name, queryset in self.get_queries(site).items():
+            start = time.monotonic()
+            for _ in range(options["repeat"]):
+                list(queryset.all())
+            elapsed = (time.monotonic() - start) / options["repeat"] * 1000
+
+            self.stdout.write(self.style.MIGRATE_HEADING(f"{name}: {elapsed:.2f} ms"))
+            self.stdout.write(queryset.explain(analyze=True))
+            self.stdout.write("")
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from system.models import SiteStatistics
+
+
+class Command(BaseCommand):
+    help = "Refresh the precomputed PC statistics of all sites"
+
+    def handle(self, *args, **options):
+        """Recompute the statistics shown on the site overviews, picking up
+        any changes not covered when PCs or their configurations change"""
+
+        statistics = SiteStatistics.refresh()
+        self.stdout.write(f"Refreshed the statistics of {len(statistics)} sites")
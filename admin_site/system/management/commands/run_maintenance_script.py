@@ -93,8 +93,8 @@ class Command(BaseCommand):
         if confirmation in ["y", "Y"]:
             for site, pcs_list in site_pcs_dict.items():
                 batch = Batch.objects.create(site=site, script=script, name="")
+                Job.create_for_pcs(batch, pcs_list, user=user)
                 for pc in pcs_list:
-                    Job.objects.create(user=user, batch=batch, pc=pc)
                     self.stdout.write(
                         self.style.SUCCESS(
                             f"Maintenance job was created for pc: {pc}"
@@ -0,0 +1,73 @@
+import logging
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from system.monitoring import OfflineMonitor, has_recent_check_ins
+from system.notifications import dispatch_notifications
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Continuously check if any notifications need to be sent and send "
+        "the pending notifications. Detects offline PCs sooner than the "
+        "check_notifications cron job, which is kept as a fallback."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--interval",
+            type=int,
+            default=60,
+            help="Seconds between each check",
+        )
+        parser.add_argument(
+            "--rule-refresh-interval",
+            type=int,
+            default=300,
+            help="Seconds between reloading the event rules",
+        )
+        parser.add_argument(
+            "--full-scan-interval",
+            type=int,
+            default=3600,
+            help="Seconds between checking all PCs instead of only recent changes",
+        )
+
+    def handle(self, *args, **options):
+        """Check if any pcs have been offline too long and send notifications,
+        once every interval, until stopped"""
+
+        interval = options["interval"]
+        monitor = OfflineMonitor(
+            rule_refresh_interval=timedelta(seconds=options["rule_refresh_interval"]),
+            full_scan_interval=timedelta(seconds=options["full_scan_interval"]),
+        )
+
+        while True:
+            start = time.monotonic()
+            now = datetime.now()
+            try:
+                if has_recent_check_ins(now):
+                    stats = monitor.check(now)
+                    self.stdout.write(
+                        f"{now:%Y-%m-%d %H:%M:%S}: Checked {stats['rules']} rules"
+                        f"{' (full scan)' if stats['full_scan'] else ''}, "
+                        f"created {stats['events']} events "
+                        f"and queued {stats['notifications']} notifications in "
+                        f"{time.monotonic() - start:.2f} seconds"
+                    )
+                sent = dispatch_notifications(now)
+                if sent:
+                    self.stdout.write(f"{now:%Y-%m-%d %H:%M:%S}: Sent {sent} e-mails")
+            except Exception:
+                logger.error("Checking notifications failed:")
+                logger.error(traceback.format_exc())
+                # Reconnect on the next check in case the connection was lost
+                connection.close()
+
+            time.sleep(max(interval - (time.monotonic() - start), 0))
@@ -1,4 +1,28 @@
+import datetime
+
 from django.db import models
+from django.db.models import Q
+
+
+class PCQuerySet(models.QuerySet):
+    def _online_filter(self, now=None):
+        from system.models import PC
+
+        if now is None:
+            now = datetime.datetime.now()
+        return Q(last_seen__gte=now - PC.ONLINE_PERIOD)
+
+    def online(self, now=None):
+        """Get PCs that have checked in within the last 5 minutes.
+
+        A check-in only writes last_seen once the stored value is older than
+        HEARTBEAT_FLUSH_INTERVAL seconds, so last_seen can lag behind by up
+        to that long, see system.heartbeat."""
+        return self.filter(self._online_filter(now))
+
+    def offline(self, now=None):
+        """Get PCs that haven't checked in within the last 5 minutes."""
+        return self.exclude(self._online_filter(now))
 
 
 class SecurityEventQuerySet(models.QuerySet):
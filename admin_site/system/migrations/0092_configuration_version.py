@@ -0,0 +1,18 @@
+# Generated by Django 4.2.15 on 2026-10-18 22:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("system", "0091_alter_configurationentry_options"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="configuration",
+            name="version",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
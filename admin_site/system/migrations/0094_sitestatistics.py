@@ -0,0 +1,35 @@
+# Generated by Django 4.2.15 on 2026-10-18 23:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("system", "0093_notification"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SiteStatistics",
+            fields=[
+                (
+                    "site",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="statistics",
+                        serialize=False,
+                        to="system.site",
+                    ),
+                ),
+                ("pc_count", models.PositiveIntegerField(default=0)),
+                ("activated_pc_count", models.PositiveIntegerField(default=0)),
+                ("borgerpc_count", models.PositiveIntegerField(default=0)),
+                ("borgerpc_kiosk_count", models.PositiveIntegerField(default=0)),
+                ("releases", models.JSONField(default=dict)),
+                ("updated", models.DateTimeField(null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.15 on 2026-10-18 23:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("system", "0094_sitestatistics"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="pc",
+            index=models.Index(
+                fields=["site", "last_seen"], name="pc_site_last_seen_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 4.2.15 on 2026-10-18 23:09
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # The tables may be large, so build the indexes without locking writes
+    atomic = False
+
+    dependencies = [
+        ("system", "0095_pc_site_last_seen_idx"),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name="job",
+            index=models.Index(fields=["pc", "status"], name="job_pc_status_idx"),
+        ),
+        AddIndexConcurrently(
+            model_name="job",
+            index=models.Index(
+                fields=["batch", "created"], name="job_batch_created_idx"
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name="securityevent",
+            index=models.Index(
+                condition=models.Q(("event_rule_server__isnull", False)),
+                fields=["event_rule_server", "pc", "reported_time"],
+                name="securityevent_rule_pc_idx",
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name="securityevent",
+            index=models.Index(
+                fields=["status", "occurred_time"], name="securityevent_status_time_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 4.2.15 on 2026-10-18 23:18
+
+from django.db import migrations, models
+from django.db.models import Exists, OuterRef
+
+
+def delete_duplicate_entries(apps, schema_editor):
+    """Keep only the newest entry of each key in a configuration. It's the
+    one that took effect, as later entries override earlier ones."""
+    ConfigurationEntry = apps.get_model("system", "ConfigurationEntry")
+
+    ConfigurationEntry.objects.filter(
+        Exists(
+            ConfigurationEntry.objects.filter(
+                owner_configuration=OuterRef("owner_configuration"),
+                key=OuterRef("key"),
+                pk__gt=OuterRef("pk"),
+            )
+        )
+    ).delete()
+
+
+class Migration(migrations.Migration):
+    # The table may be large, so build the unique index without locking
+    # writes, and then turn it into the constraint
+    atomic = False
+
+    dependencies = [
+        ("system", "0096_hot_query_indexes"),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            delete_duplicate_entries, migrations.RunPython.noop, atomic=True
+        ),
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(
+                    "CREATE UNIQUE INDEX CONCURRENTLY unique_configuration_key "
+                    "ON system_configurationentry (owner_configuration_id, key)",
+                    "DROP INDEX CONCURRENTLY IF EXISTS unique_configuration_key",
+                ),
+                migrations.RunSQL(
+                    "ALTER TABLE system_configurationentry "
+                    "ADD CONSTRAINT unique_configuration_key "
+                    "UNIQUE USING INDEX unique_configuration_key",
+                    "ALTER TABLE system_configurationentry "
+                    "DROP CONSTRAINT unique_configuration_key",
+                ),
+            ],
+            state_operations=[
+                migrations.AddConstraint(
+                    model_name="configurationentry",
+                    constraint=models.UniqueConstraint(
+                        fields=("owner_configuration", "key"),
+                        name="unique_configuration_key",
+                    ),
+                ),
+            ],
+        ),
+    ]
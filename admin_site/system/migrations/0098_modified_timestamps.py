@@ -0,0 +1,48 @@
+# Generated by Django 4.2.15 on 2026-10-18 23:27
+
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # The tables may be large, so build the indexes without locking writes.
+    # Existing rows get the time of the migration as modification time.
+    atomic = False
+
+    dependencies = [
+        ("system", "0097_configurationentry_unique_key"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="job",
+            name="modified",
+            field=models.DateTimeField(auto_now=True, verbose_name="modified"),
+        ),
+        migrations.AddField(
+            model_name="pc",
+            name="modified",
+            field=models.DateTimeField(auto_now=True, verbose_name="modified"),
+        ),
+        migrations.AddField(
+            model_name="securityevent",
+            name="modified",
+            field=models.DateTimeField(auto_now=True, verbose_name="modified"),
+        ),
+        AddIndexConcurrently(
+            model_name="job",
+            index=models.Index(fields=["modified", "id"], name="job_modified_idx"),
+        ),
+        AddIndexConcurrently(
+            model_name="pc",
+            index=models.Index(
+                fields=["site", "modified", "id"], name="pc_site_modified_idx"
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name="securityevent",
+            index=models.Index(
+                fields=["modified", "id"], name="securityevent_modified_idx"
+            ),
+        ),
+    ]
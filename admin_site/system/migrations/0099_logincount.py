@@ -0,0 +1,74 @@
+# Generated by Django 4.2.15 on 2026-10-18 23:29
+
+import datetime
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def copy_login_counts(apps, schema_editor):
+    """Fill in the counts from the login_counts configuration values."""
+    ConfigurationEntry = apps.get_model("system", "ConfigurationEntry")
+    LoginCount = apps.get_model("system", "LoginCount")
+
+    login_counts = []
+    for pc_id, value in (
+        ConfigurationEntry.objects.filter(
+            key="login_counts", owner_configuration__pc__isnull=False
+        )
+        .values_list("owner_configuration__pc", "value")
+        .iterator()
+    ):
+        for item in value.split(","):
+            try:
+                day, count = item.split(":")
+                day = datetime.date.fromisoformat(day.strip())
+                count = int(count)
+            except ValueError:
+                continue
+            if count >= 0:
+                login_counts.append(LoginCount(pc_id=pc_id, date=day, count=count))
+        if len(login_counts) >= 1000:
+            LoginCount.objects.bulk_create(login_counts, ignore_conflicts=True)
+            login_counts = []
+    LoginCount.objects.bulk_create(login_counts, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("system", "0098_modified_timestamps"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="LoginCount",
+            fields=[
+                (
+                    "id",
+                    models.AutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("date", models.DateField(verbose_name="date")),
+                ("count", models.PositiveIntegerField(verbose_name="count")),
+                (
+                    "pc",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="login_counts",
+                        to="system.pc",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name="logincount",
+            constraint=models.UniqueConstraint(
+                fields=("pc", "date"), name="unique_pc_date"
+            ),
+        ),
+        migrations.RunPython(copy_login_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.15 on 2026-10-18 23:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("system", "0099_logincount"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="logincount",
+            index=models.Index(fields=["date"], name="logincount_date_idx"),
+        ),
+    ]
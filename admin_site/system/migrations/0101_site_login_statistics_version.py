@@ -0,0 +1,18 @@
+# Generated by Django 4.2.15 on 2026-10-19 00:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("system", "0100_logincount_date_idx"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="site",
+            name="login_statistics_version",
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
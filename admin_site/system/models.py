@@ -1,18 +1,37 @@
 import datetime
+import hashlib
 import random
 import re
 import string
 
 from django.db import models, transaction
-from django.db.models import Q
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db.models import (
+    Case,
+    Count,
+    F,
+    Func,
+    OuterRef,
+    Q,
+    Subquery,
+    Value,
+    When,
+)
+from django.db.models.fields.json import KeyTextTransform
+from django.db.models.functions import Cast, Coalesce, Greatest
+from django.db.models.lookups import GreaterThan
+from django.db.models.signals import m2m_changed, post_delete
+from django.dispatch import receiver
 from django.utils.translation import gettext_lazy as _
 from django.utils import timezone
 from django.contrib.auth.models import User
 from django.urls import reverse
 from django.core.validators import MinValueValidator, RegexValidator
 
+from system import heartbeat
 from system.mixins import AuditModelMixin
-from system.managers import SecurityEventQuerySet
+from system.managers import PCQuerySet, SecurityEventQuerySet
 
 """The following variables define states of objects like jobs or PCs. It is
 used for labeling in the GUI."""
@@ -64,11 +83,23 @@ class Configuration(models.Model):
     # Doesn't need any actual fields, it seems. Should not exist independently
     # of the classes to which it may be aggregated.
     name = models.CharField(max_length=255, unique=True)
+    # Incremented on every change to the entries, so cached PC configurations
+    # built from this configuration can be recognized as stale.
+    version = models.PositiveIntegerField(default=0, editable=False)
 
-    def update_from_request(self, req_params, submit_name):
-        seen_set = set()
+    def bump_version(self):
+        Configuration.objects.filter(pk=self.pk).update(version=F("version") + 1)
+
+    def parse_request(self, req_params, submit_name):
+        """Return the existing entries by pk, the submitted changes to them as
+        a dict mapping their pks to (key, value) and the new entries as a dict
+        from the submitted configuration form.
 
-        existing_set = set(cnf.pk for cnf in self.entries.all())
+        Raises ValidationError if two submitted entries would get the same
+        key."""
+        existing = self.entries.in_bulk()
+        updated = {}
+        new_entries = {}
 
         unique_names = set(req_params.getlist(submit_name, []))
         for pk in unique_names:
@@ -80,33 +111,91 @@ class Configuration(models.Model):
 
             if pk.startswith("new_"):
                 # Create one or more new entries
-                for k, v in zip(key, value):
-                    cnf = ConfigurationEntry(key=k, value=v, owner_configuration=self)
-                    cnf.save()
-            else:
-                # Update submitted entry
-                cnf = ConfigurationEntry.objects.get(pk=pk)
-                cnf.key = key[0]
-                cnf.value = value[0]
-                seen_set.add(cnf.pk)
-                cnf.save()
-
-        # Delete entries that were not in the submitted data
-        for pk in existing_set - seen_set:
-            cnf = ConfigurationEntry.objects.get(pk=pk)
-            cnf.delete()
+                new_entries.update(zip(key, value))
+            elif pk.isdigit() and int(pk) in existing:
+                updated[int(pk)] = (key[0], value[0])
+
+        keys = [key for key, value in updated.values()]
+        duplicates = sorted({key for key in keys if keys.count(key) > 1})
+        if duplicates:
+            raise ValidationError(
+                _("More than one configuration entry has the key %s")
+                % ", ".join(duplicates)
+            )
+        return existing, updated, new_entries
+
+    def update_from_request(self, req_params, submit_name):
+        """Update the entries from the submitted configuration form.
+
+        Submitted entries are updated, new entries are added, overwriting
+        any entry with the same key, and entries left out are deleted.
+        Raises ValidationError, without changing anything, if two submitted
+        entries would get the same key."""
+        existing, updated, new_entries = self.parse_request(req_params, submit_name)
+
+        # Renamed entries are recreated, as renaming them in place could
+        # clash with the old key of another renamed entry
+        renamed = {
+            pk: (key, value)
+            for pk, (key, value) in updated.items()
+            if key != existing[pk].key
+        }
+        changed = [
+            existing[pk]
+            for pk, (key, value) in updated.items()
+            if pk not in renamed and value != existing[pk].value
+        ]
+        for entry in changed:
+            entry.value = updated[entry.pk][1]
+
+        with transaction.atomic():
+            # Entries that were not in the submitted data are deleted before
+            # the new entries are added, so a new entry replacing a deleted
+            # one with the same key is kept
+            ConfigurationEntry.objects.filter(
+                pk__in=(set(existing) - set(updated)) | set(renamed)
+            ).delete()
+            ConfigurationEntry.objects.bulk_update(changed, ["value"])
+            self.update_entries({**dict(renamed.values()), **new_entries})
+
+            # The login counts of a PC are also stored as LoginCounts
+            keys = {entry.key for entry in existing.values()}
+            keys.update(key for key, value in updated.values())
+            keys.update(new_entries)
+            if "login_counts" in keys:
+                value = (
+                    self.entries.filter(key="login_counts")
+                    .values_list("value", flat=True)
+                    .first()
+                )
+                for pc_id in PC.objects.filter(configuration=self).values_list(
+                    "pk", flat=True
+                ):
+                    LoginCount.store(pc_id, value)
 
     def remove_entry(self, key):
-        return self.entries.filter(key=key).delete()
+        result = self.entries.filter(key=key).delete()
+        self.bump_version()
+        return result
 
     def update_entry(self, key, value):
-        try:
-            e = self.entries.get(key=key)
-            e.value = value
-        except ConfigurationEntry.DoesNotExist:
-            e = ConfigurationEntry(owner_configuration=self, key=key, value=value)
-        finally:
-            e.save()
+        self.update_entries({key: value})
+
+    def update_entries(self, entries):
+        """Set the entries in the dict, creating the ones that don't exist.
+
+        The entries are upserted in a single query, so concurrent updates of
+        the same key can't create duplicates."""
+        ConfigurationEntry.objects.bulk_create(
+            [
+                ConfigurationEntry(owner_configuration=self, key=key, value=value)
+                for key, value in entries.items()
+            ],
+            update_conflicts=True,
+            unique_fields=["owner_configuration", "key"],
+            update_fields=["value"],
+        )
+        self.bump_version()
 
     def get(self, key, default=None):
         """Return value of the entry corresponding to key if it exists, None
@@ -140,9 +229,24 @@ class ConfigurationEntry(models.Model):
         on_delete=models.CASCADE,
     )
 
+    def save(self, *args, **kwargs):
+        super(ConfigurationEntry, self).save(*args, **kwargs)
+        Configuration(pk=self.owner_configuration_id).bump_version()
+
+    def delete(self, *args, **kwargs):
+        result = super(ConfigurationEntry, self).delete(*args, **kwargs)
+        Configuration(pk=self.owner_configuration_id).bump_version()
+        return result
+
     class Meta:
         ordering = ["key"]
         verbose_name_plural = "configuration entries"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["owner_configuration", "key"],
+                name="unique_configuration_key",
+            ),
+        ]
 
 
 class Country(models.Model):
@@ -200,6 +304,10 @@ class Site(models.Model):
     created = models.DateTimeField(
         verbose_name=_("created"), auto_now_add=True, null=True
     )
+    # Incremented whenever cached login statistics of the site may be stale,
+    # see system.login_statistics. Kept in the database, as the cache may be
+    # per process.
+    login_statistics_version = models.PositiveIntegerField(default=0, editable=False)
     # Official library number
     # https://slks.dk/omraader/kulturinstitutioner/biblioteker/biblioteksstandardisering/biblioteksnumre
 
@@ -314,6 +422,15 @@ class Site(models.Model):
             except Configuration.DoesNotExist:
                 self.configuration = Configuration.objects.create(name=self.uid)
 
+        # 3. Don't write back a login statistics version that may have been
+        # incremented since the site was loaded.
+        if not is_new and not args and kwargs.get("update_fields") is None:
+            kwargs["update_fields"] = [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != "login_statistics_version"
+            ]
+
         # Perform save
         super(Site, self).save(*args, **kwargs)
 
@@ -324,6 +441,191 @@ class Site(models.Model):
         return reverse("settings", kwargs={"slug": self.uid})
 
 
+class SiteStatistics(models.Model):
+    """Precomputed statistics about the PCs on a site, for the site overviews.
+
+    The statistics are updated incrementally when PCs are registered, changed
+    or deleted and when clients report a new product or release. They are
+    recomputed periodically by the refresh_site_statistics command, which
+    picks up any changes made in bulk. The number of online PCs changes all the
+    time, so it's not stored but counted when the statistics are read."""
+
+    site = models.OneToOneField(
+        Site, primary_key=True, related_name="statistics", on_delete=models.CASCADE
+    )
+    pc_count = models.PositiveIntegerField(default=0)
+    activated_pc_count = models.PositiveIntegerField(default=0)
+    borgerpc_count = models.PositiveIntegerField(default=0)
+    borgerpc_kiosk_count = models.PositiveIntegerField(default=0)
+    # Maps the _os_release values of the PCs to the number of PCs
+    releases = models.JSONField(default=dict)
+    updated = models.DateTimeField(null=True)
+
+    COUNT_FIELDS = (
+        "pc_count",
+        "activated_pc_count",
+        "borgerpc_count",
+        "borgerpc_kiosk_count",
+    )
+
+    PRODUCT_FIELDS = {
+        "os2borgerpc": "borgerpc_count",
+        "os2borgerpc kiosk": "borgerpc_kiosk_count",
+    }
+
+    @classmethod
+    def refresh(cls, site_ids=None):
+        """Recompute and store the statistics of the sites with the given ids,
+        or of all sites."""
+        sites = Site.objects.all()
+        if site_ids is not None:
+            sites = sites.filter(pk__in=site_ids)
+        now = datetime.datetime.now()
+        statistics = {
+            site_id: cls(site_id=site_id, updated=now)
+            for site_id in sites.values_list("pk", flat=True)
+        }
+        if not statistics:
+            return []
+
+        for site_id, pc_count, activated_pc_count in (
+            PC.objects.filter(site__in=statistics.keys())
+            .order_by()
+            .values("site")
+            .annotate(
+                total=Count("pk"), activated=Count("pk", filter=Q(is_activated=True))
+            )
+            .values_list("site", "total", "activated")
+        ):
+            statistics[site_id].pc_count = pc_count
+            statistics[site_id].activated_pc_count = activated_pc_count
+
+        for site_id, key, value, count in (
+            ConfigurationEntry.objects.filter(
+                owner_configuration__pc__site__in=statistics.keys(),
+                key__in=["os2_product", "_os_release"],
+            )
+            .order_by()
+            .values("owner_configuration__pc__site", "key", "value")
+            .annotate(count=Count("owner_configuration__pc"))
+            .values_list("owner_configuration__pc__site", "key", "value", "count")
+        ):
+            if key == "_os_release":
+                statistics[site_id].releases[value] = count
+            elif value in cls.PRODUCT_FIELDS:
+                setattr(statistics[site_id], cls.PRODUCT_FIELDS[value], count)
+
+        return cls.objects.bulk_create(
+            statistics.values(),
+            update_conflicts=True,
+            unique_fields=["site"],
+            update_fields=[*cls.COUNT_FIELDS, "releases", "updated"],
+        )
+
+    @classmethod
+    def get_counters(cls, is_activated, config):
+        """Return the counters a PC contributes to, given whether it's
+        activated and its os2_product and _os_release configuration values.
+        Releases are given as ("releases", release) pairs."""
+        counters = {"pc_count"}
+        if is_activated:
+            counters.add("activated_pc_count")
+        if config.get("os2_product") in cls.PRODUCT_FIELDS:
+            counters.add(cls.PRODUCT_FIELDS[config["os2_product"]])
+        if config.get("_os_release") is not None:
+            counters.add(("releases", config["_os_release"]))
+        return counters
+
+    @classmethod
+    def apply_change(cls, site_id, removed=(), added=()):
+        """Update the statistics of the site incrementally, subtracting the
+        counters in removed and adding those in added, e.g. the counters of
+        a PC before and after it changed.
+
+        Only the changed counters are written, relative to the stored values,
+        so concurrent changes don't overwrite each other. Changes that bypass
+        this are picked up by refresh_site_statistics."""
+        deltas = {}
+        for counter in removed:
+            deltas[counter] = deltas.get(counter, 0) - 1
+        for counter in added:
+            deltas[counter] = deltas.get(counter, 0) + 1
+
+        changes = {}
+        releases = F("releases")
+        for counter, delta in deltas.items():
+            if not delta:
+                continue
+            if isinstance(counter, tuple):
+                release = counter[1]
+                count = Coalesce(
+                    Cast(KeyTextTransform(release, "releases"), models.IntegerField()),
+                    0,
+                )
+                # Releases no PCs have any more are removed
+                releases = Case(
+                    When(
+                        GreaterThan(count + delta, 0),
+                        then=Func(
+                            releases,
+                            Func(Value(release), template="ARRAY[%(expressions)s]"),
+                            Func(count + delta, function="to_jsonb"),
+                            function="jsonb_set",
+                        ),
+                    ),
+                    default=Func(
+                        releases,
+                        Value(release),
+                        template="%(expressions)s",
+                        arg_joiner=" - ",
+                    ),
+                    output_field=models.JSONField(),
+                )
+                changes["releases"] = releases
+            else:
+                changes[counter] = Greatest(F(counter) + delta, 0)
+        if changes:
+            cls.objects.filter(site=site_id).update(**changes)
+
+    @classmethod
+    def with_online_pc_count(cls):
+        online_pcs = (
+            PC.objects.online()
+            .filter(site=OuterRef("site"))
+            .order_by()
+            .values("site")
+            .annotate(count=Count("pk"))
+            .values("count")
+        )
+        return cls.objects.annotate(online_pc_count=Coalesce(Subquery(online_pcs), 0))
+
+    @classmethod
+    def summarize(cls, site_ids):
+        """Return the combined statistics of the sites with the given ids,
+        including the number of online PCs, computing the statistics first
+        for any sites that have none yet."""
+        site_ids = set(site_ids)
+        statistics = list(cls.with_online_pc_count().filter(site__in=site_ids))
+        missing = site_ids - {site_statistics.site_id for site_statistics in statistics}
+        if missing:
+            cls.refresh(missing)
+            statistics += cls.with_online_pc_count().filter(site__in=missing)
+
+        summary = dict.fromkeys([*cls.COUNT_FIELDS, "online_pc_count"], 0)
+        releases = {}
+        for site_statistics in statistics:
+            for field in summary:
+                summary[field] += getattr(site_statistics, field)
+            for release, count in site_statistics.releases.items():
+                if count:
+                    releases[release] = releases.get(release, 0) + count
+        summary["releases"] = sorted(releases.items())
+        return summary
+
+    def __str__(self):
+        return str(self.site)
+
+
 class LoginLog(models.Model):
     """A log of a single login on a borgerPC containing a citizen identifier,
     the related site, the date of login, the time of login and the time of logout."""
@@ -341,6 +643,76 @@ class LoginLog(models.Model):
         ordering = ["date", "identifier", "login_time"]
 
 
+class LoginCount(models.Model):
+    """The number of logins on a PC on a given day, as reported by the
+    client in the login_counts configuration value."""
+
+    pc = models.ForeignKey("PC", related_name="login_counts", on_delete=models.CASCADE)
+    date = models.DateField(verbose_name=_("date"))
+    count = models.PositiveIntegerField(verbose_name=_("count"))
+
+    @staticmethod
+    def parse(value):
+        """Parse a login_counts value like "2023-10-10: 4, 2023-10-11: 2" into
+        a dict mapping dates to counts. Malformed items are skipped."""
+        counts = {}
+        for item in value.split(","):
+            try:
+                day, count = item.split(":")
+                counts[datetime.date.fromisoformat(day.strip())] = int(count)
+            except ValueError:
+                continue
+        return counts
+
+    @classmethod
+    def store(cls, pc_id, value):
+        """Replace the counts stored for the PC with those of a login_counts
+        value, or delete them if the value is None. Only the counts that
+        changed are written.
+
+        Returns the days whose counts changed."""
+        counts = {}
+        if value is not None:
+            counts = {
+                day: count for day, count in cls.parse(value).items() if count >= 0
+            }
+        stored = dict(cls.objects.filter(pc=pc_id).values_list("date", "count"))
+        removed = stored.keys() - counts.keys()
+        changed = {
+            day: count for day, count in counts.items() if stored.get(day) != count
+        }
+
+        if removed:
+            cls.objects.filter(pc=pc_id, date__in=removed).delete()
+        if changed:
+            cls.objects.bulk_create(
+                [
+                    cls(pc_id=pc_id, date=day, count=count)
+                    for day, count in changed.items()
+                ],
+                update_conflicts=True,
+                unique_fields=["pc", "date"],
+                update_fields=["count"],
+            )
+        changed_days = removed | changed.keys()
+
+        # The cached login statistics of closed days a PC reported late
+        from system import login_statistics
+
+        if any(login_statistics.is_closed(day) for day in changed_days):
+            login_statistics.invalidate(Site.objects.filter(pcs=pc_id))
+        return changed_days
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["pc", "date"], name="unique_pc_date"),
+        ]
+        indexes = [
+            # Logins of all PCs on given days, see system.login_statistics
+            models.Index(fields=["date"], name="logincount_date_idx"),
+        ]
+
+
 class FeaturePermission(models.Model):
     name = models.CharField(verbose_name=_("name"), max_length=255)
     uid = models.CharField(verbose_name=_("UID"), max_length=255, unique=True)
@@ -611,6 +983,11 @@ class PCGroup(models.Model):
         # After save
         pass
 
+    def delete(self, *args, **kwargs):
+        # Losing the group is a modification of its PCs
+        self.pcs.update(modified=timezone.now())
+        return super().delete(*args, **kwargs)
+
     @transaction.atomic
     def update_associated_script_positions(self):
         groups_policy_scripts = [asc for asc in self.policy.all().order_by("position")]
@@ -727,6 +1104,8 @@ class Product(models.Model):
 class PC(models.Model):
     """This class represents one PC, i.e. one client of the admin system."""
 
+    objects = PCQuerySet.as_manager()
+
     mac = models.CharField(verbose_name=_("MAC"), max_length=255, blank=True)
     name = models.CharField(verbose_name=_("name"), max_length=255)
     uid = models.CharField(
@@ -742,6 +1121,9 @@ class PC(models.Model):
     created = models.DateTimeField(
         verbose_name=_("created"), auto_now_add=True, null=True
     )
+    # Bulk updates must set this explicitly, see the incremental sync in
+    # system.api. Check-ins don't count as modifications.
+    modified = models.DateTimeField(verbose_name=_("modified"), auto_now=True)
     last_seen = models.DateTimeField(verbose_name=_("last seen"), null=True, blank=True)
     location = models.CharField(
         verbose_name=_("location"), max_length=1024, blank=True, default=""
@@ -750,13 +1132,26 @@ class PC(models.Model):
         Product, on_delete=models.PROTECT, blank=True, null=True
     )
 
+    # Configuration layers, in order of increasing precedence
+    CONFIG_LAYER_SITE = 0
+    CONFIG_LAYER_GROUP = 1
+    CONFIG_LAYER_PC = 2
+
+    CONFIG_CACHE_TIMEOUT = 60 * 60 * 24
+
+    ONLINE_PERIOD = datetime.timedelta(minutes=5)
+
     @property
     def online(self):
         """A PC being online is defined as last seen less than 5 minutes ago."""
-        if not self.last_seen:
+        return self.is_online_at(heartbeat.last_seen(self))
+
+    @staticmethod
+    def is_online_at(last_seen):
+        if not last_seen:
             return False
         now = timezone.now()
-        return self.last_seen >= now - datetime.timedelta(minutes=5)
+        return last_seen >= now - PC.ONLINE_PERIOD
 
     class Status:
         """This class represents the status of af PC. We may want to do
@@ -780,29 +1175,94 @@ class PC(models.Model):
             else:
                 return self.Status(OK, None)
 
-    def get_list_of_configurations(self):
-        configs = [self.site.configuration]
-        configs.extend([g.configuration for g in self.pc_groups.all()])
-        configs.append(self.configuration)
-        return configs
+    def get_config_entries(self, keys=None):
+        """Return the configuration entries of the site, the groups and the
+        PC itself in a single query.
+
+        The entries are annotated with their configuration layer and ordered by
+        precedence, so that later entries override earlier ones: site first,
+        then groups by name and finally the PC."""
+        site_configuration = Site.objects.filter(pk=self.site_id).values(
+            "configuration"
+        )
+        # A single IN over a UNION lets the database look the entries up by
+        # configuration, where ORing the conditions makes it scan them all
+        configurations = (
+            Configuration.objects.filter(pk=self.configuration_id)
+            .values("pk")
+            .union(
+                site_configuration,
+                self.pc_groups.values("configuration"),
+                all=True,
+            )
+        )
+        entries = (
+            ConfigurationEntry.objects.filter(owner_configuration__in=configurations)
+            .annotate(
+                layer=Case(
+                    When(
+                        owner_configuration=self.configuration_id,
+                        then=Value(self.CONFIG_LAYER_PC),
+                    ),
+                    When(
+                        owner_configuration__in=site_configuration,
+                        then=Value(self.CONFIG_LAYER_SITE),
+                    ),
+                    default=Value(self.CONFIG_LAYER_GROUP),
+                ),
+                group_name=Subquery(
+                    PCGroup.objects.filter(
+                        configuration=OuterRef("owner_configuration")
+                    ).values("name")[:1]
+                ),
+            )
+            .order_by("layer", "group_name", "pk")
+        )
+        if keys is not None:
+            entries = entries.filter(key__in=keys)
+        return entries
+
+    def get_merged_config(self, keys=None):
+        """Return the configuration of the PC as a dict, with the PC's own
+        entries overriding those of its groups, which override the site's."""
+        return dict(self.get_config_entries(keys).values_list("key", "value"))
+
+    def get_config_versions(self):
+        """Return the versions of the configurations that make up the
+        configuration of this PC. Group names are included, as they decide the
+        precedence between groups."""
+        return sorted(
+            Configuration.objects.filter(
+                Q(pk=self.configuration_id)
+                | Q(site=self.site_id)
+                | Q(pcgroup__pcs=self)
+            )
+            .values_list("pk", "version", "pcgroup__name")
+            .distinct()
+        )
+
+    def get_cached_config(self):
+        """Return the merged configuration of the PC, reusing the cached
+        snapshot if none of the underlying configurations have changed."""
+        cache_key = f"pc_config:{self.pk}"
+        versions = self.get_config_versions()
+        snapshot = cache.get(cache_key)
+        if snapshot is not None and snapshot["versions"] == versions:
+            return dict(snapshot["config"])
+
+        config = self.get_merged_config()
+        cache.set(
+            cache_key,
+            {"versions": versions, "config": config},
+            self.CONFIG_CACHE_TIMEOUT,
+        )
+        return dict(config)
 
     def get_config_value(self, key, default=None):
-        value = default
-        configs = self.get_list_of_configurations()
-        for conf in configs:
-            try:
-                entry = conf.entries.get(key=key)
-                value = entry.value
-            except ConfigurationEntry.DoesNotExist:
-                pass
-        return value
+        return self.get_merged_config([key]).get(key, default)
 
     def get_full_config(self):
-        result = {}
-        configs = self.get_list_of_configurations()
-        for conf in configs:
-            for entry in conf.entries.all():
-                result[entry.key] = entry.value
+        result = self.get_cached_config()
         if "mac" not in result.keys():
             result["mac"] = self.mac
         result["uid"] = self.uid
@@ -811,30 +1271,131 @@ class PC(models.Model):
     def get_merged_config_list(self, key, default=None):
         result = default[:] if default is not None else []
 
-        configs = [self.site.configuration]
-        configs.extend([g.configuration for g in self.pc_groups.all()])
-        configs.append(self.configuration)
-
-        for conf in configs:
-            try:
-                entry = conf.entries.get(key=key)
-                for v in entry.value.split(","):
-                    v = v.strip()
-                    if v != "" and v not in result:
-                        result.append(v)
-            except ConfigurationEntry.DoesNotExist:
-                pass
+        for value in self.get_config_entries([key]).values_list("value", flat=True):
+            for v in value.split(","):
+                v = v.strip()
+                if v != "" and v not in result:
+                    result.append(v)
 
         return result
 
     def get_absolute_url(self):
         return reverse("computer", args=(self.site.uid, self.uid))
 
+    def get_statistics_config(self):
+        """Return the configuration values of the PC counted in the site
+        statistics."""
+        return dict(
+            ConfigurationEntry.objects.filter(
+                owner_configuration=self.configuration_id,
+                key__in=["os2_product", "_os_release"],
+            ).values_list("key", "value")
+        )
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the values the site statistics depend on, so save() can
+        # tell what changed without reading them again
+        if "site_id" in field_names and "is_activated" in field_names:
+            instance._statistics_values = {
+                "site": instance.site_id,
+                "is_activated": instance.is_activated,
+            }
+        return instance
+
+    def save(self, *args, **kwargs):
+        """Keep the statistics of the PC's site, and any site it's moved from,
+        up to date."""
+        from system import login_statistics
+
+        update_fields = kwargs.get("update_fields")
+        tracked = update_fields is None or not {
+            "site",
+            "site_id",
+            "is_activated",
+        }.isdisjoint(update_fields)
+        is_new = self.pk is None
+        old = None
+        if not is_new and tracked:
+            old = getattr(self, "_statistics_values", None)
+            if old is None:
+                old = (
+                    PC.objects.filter(pk=self.pk).values("site", "is_activated").first()
+                )
+                is_new = old is None
+        super(PC, self).save(*args, **kwargs)
+        if self.get_deferred_fields().isdisjoint({"site_id", "is_activated"}):
+            self._statistics_values = {
+                "site": self.site_id,
+                "is_activated": self.is_activated,
+            }
+
+        if is_new:
+            SiteStatistics.apply_change(
+                self.site_id,
+                added=SiteStatistics.get_counters(
+                    self.is_activated, self.get_statistics_config()
+                ),
+            )
+        elif old is None:
+            return
+        elif old["site"] != self.site_id:
+            login_statistics.invalidate(
+                Site.objects.filter(pk__in=[old["site"], self.site_id])
+            )
+            config = self.get_statistics_config()
+            SiteStatistics.apply_change(
+                old["site"],
+                removed=SiteStatistics.get_counters(old["is_activated"], config),
+            )
+            SiteStatistics.apply_change(
+                self.site_id,
+                added=SiteStatistics.get_counters(self.is_activated, config),
+            )
+        elif old["is_activated"] != self.is_activated:
+            SiteStatistics.apply_change(
+                self.site_id,
+                removed=SiteStatistics.get_counters(old["is_activated"], {}),
+                added=SiteStatistics.get_counters(self.is_activated, {}),
+            )
+
     def __str__(self):
         return self.name
 
     class Meta:
         ordering = ["name"]
+        indexes = [
+            models.Index(fields=["site", "last_seen"], name="pc_site_last_seen_idx"),
+            models.Index(
+                fields=["site", "modified", "id"], name="pc_site_modified_idx"
+            ),
+        ]
+
+
+@receiver(post_delete, sender=PC)
+def remove_pc_from_statistics(sender, instance, **kwargs):
+    """Keep the statistics of the site up to date when a PC is deleted,
+    including by deleting a queryset or a related object."""
+    from system import login_statistics
+
+    SiteStatistics.apply_change(
+        instance.site_id,
+        removed=SiteStatistics.get_counters(
+            instance.is_activated, instance.get_statistics_config()
+        ),
+    )
+    login_statistics.invalidate(Site.objects.filter(pk=instance.site_id))
+
+
+@receiver(m2m_changed, sender=PC.pc_groups.through)
+def invalidate_group_login_statistics(sender, instance, action, **kwargs):
+    """The cached login statistics of a site are per group, so they are
+    dropped when the groups of its PCs change."""
+    from system import login_statistics
+
+    if action in ("post_add", "post_remove", "post_clear"):
+        login_statistics.invalidate(Site.objects.filter(pk=instance.site_id))
 
 
 class ScriptTag(models.Model):
@@ -892,6 +1453,8 @@ class Script(AuditModelMixin):
         Product, related_name="scripts_for_product", blank=True
     )
 
+    CODE_CACHE_TIMEOUT = 60 * 60 * 24
+
     @property
     def is_global(self):
         return self.site is None
@@ -899,6 +1462,24 @@ class Script(AuditModelMixin):
     def __str__(self):
         return self.name
 
+    @property
+    def code_version(self):
+        """Identifies the current executable code. As the code can only be
+        replaced by saving the script, this changes whenever the code might."""
+        modified = self.modified.timestamp() if self.modified else 0
+        return f"{self.pk}:{modified}"
+
+    def get_executable_code(self):
+        """Return the decoded executable code, read from storage only when the
+        script has been saved since it was last cached."""
+        cache_key = f"script_code:{self.code_version}"
+        code = cache.get(cache_key)
+        if code is None:
+            with self.executable_code.open("rb") as code_file:
+                code = code_file.read().decode("utf8")
+            cache.set(cache_key, code, self.CODE_CACHE_TIMEOUT)
+        return code
+
     def run_on(self, site, pc_list, *args, user):
         batch = Batch(site=site, script=self, name="")
         batch.save()
@@ -906,6 +1487,7 @@ class Script(AuditModelMixin):
         parameter_values = "["
 
         # Add parameters
+        params = []
         for i, inp in enumerate(self.ordered_inputs):
             if i < len(args):
                 value = args[i]
@@ -917,7 +1499,8 @@ class Script(AuditModelMixin):
                     p = BatchParameter(input=inp, batch=batch, file_value=value)
                 else:
                     p = BatchParameter(input=inp, batch=batch, string_value=value)
-                p.save()
+                params.append(p)
+        BatchParameter.objects.bulk_create(params)
 
         if len(parameter_values) > 1:
             parameter_values = parameter_values[:-2]
@@ -925,9 +1508,7 @@ class Script(AuditModelMixin):
 
         log_output = f"New job with arguments {parameter_values}"
 
-        for pc in pc_list:
-            job = Job(batch=batch, pc=pc, user=user, log_output=log_output)
-            job.save()
+        Job.create_for_pcs(batch, pc_list, user=user, log_output=log_output)
 
         return batch
 
@@ -986,13 +1567,18 @@ class AssociatedScript(models.Model):
 
     def make_parameters(self, batch):
         params = []
+        parameters = {
+            asp.input_id: asp for asp in self.parameters.select_related("input")
+        }
         for i in self.script.ordered_inputs.all():
             try:
-                asp = self.parameters.get(input=i)
-                params.append(asp.make_batch_parameter(batch))
-            except AssociatedScriptParameter.DoesNotExist:
+                asp = parameters[i.id]
+            except KeyError:
                 # XXX
-                raise
+                raise AssociatedScriptParameter.DoesNotExist(
+                    f"No parameter for input {i} of {self}"
+                )
+            params.append(asp.make_batch_parameter(batch))
         return params
 
     @property
@@ -1006,10 +1592,11 @@ Runs this script on several PCs, returning a batch representing this task."""
         batch.save()
         params = self.make_parameters(batch)
 
+        BatchParameter.objects.bulk_create(params)
+
         parameter_values = "["
 
         for p in params:
-            p.save()
             if p.file_value:
                 parameter_values += str(p.file_value) + ", "
             elif p.input.value_type == Input.PASSWORD:
@@ -1023,9 +1610,7 @@ Runs this script on several PCs, returning a batch representing this task."""
 
         log_output = f"New job with arguments {parameter_values}"
 
-        for pc in pcs:
-            job = Job(batch=batch, pc=pc, user=user, log_output=log_output)
-            job.save()
+        Job.create_for_pcs(batch, pcs, user=user, log_output=log_output)
 
         return batch
 
@@ -1089,6 +1674,9 @@ class Job(models.Model):
     created = models.DateTimeField(
         verbose_name=_("created"), auto_now_add=True, null=True
     )
+    # Bulk updates must set this explicitly, see the incremental sync in
+    # system.api
+    modified = models.DateTimeField(verbose_name=_("modified"), auto_now=True)
     started = models.DateTimeField(verbose_name=_("started"), null=True)
     finished = models.DateTimeField(verbose_name=_("finished"), null=True)
     user = models.ForeignKey(User, null=True, on_delete=models.SET_NULL)
@@ -1098,6 +1686,13 @@ class Job(models.Model):
     def __str__(self):
         return "_".join(map(str, [self.batch, self.id]))
 
+    @classmethod
+    def create_for_pcs(cls, batch, pcs, **kwargs):
+        """Create a job in the batch for each of the PCs in a single query."""
+        return cls.objects.bulk_create(
+            [cls(batch=batch, pc=pc, **kwargs) for pc in pcs]
+        )
+
     @property
     def has_info(self):
         return self.status == Job.FAILED or len(self.log_output) > 1
@@ -1124,7 +1719,10 @@ class Job(models.Model):
     def as_instruction(self):
         parameters = []
 
-        for param in self.batch.parameters.order_by("input__position"):
+        # Sorted here rather than in the query, so prefetched parameters are used
+        for param in sorted(
+            self.batch.parameters.all(), key=lambda param: param.input.position
+        ):
             parameters.append(
                 {"type": param.input.value_type, "value": param.transfer_value}
             )
@@ -1134,7 +1732,7 @@ class Job(models.Model):
             "name": self.batch.script.name,
             "status": self.status,
             "parameters": parameters,
-            "executable_code": self.batch.script.executable_code.read().decode("utf8"),
+            "executable_code": self.batch.script.get_executable_code(),
         }
 
     def resolve(self):
@@ -1183,6 +1781,19 @@ class Job(models.Model):
 
         return new_job
 
+    class Meta:
+        indexes = [
+            # Outstanding jobs of a PC, see PC.status and rpc.claim_jobs
+            models.Index(fields=["pc", "status"], name="job_pc_status_idx"),
+            # Jobs of a site created in a given period, see api.get_site_jobs.
+            # The site is on the batch and an index can't span the join, so
+            # the site's batches are found first and the jobs of each batch
+            # in the period through this index.
+            models.Index(fields=["batch", "created"], name="job_batch_created_idx"),
+            # Jobs changed since a given time, see api.get_jobs
+            models.Index(fields=["modified", "id"], name="job_modified_idx"),
+        ]
+
 
 class Input(models.Model):
     """Input for a script"""
@@ -1336,6 +1947,40 @@ class SecurityProblem(EventRuleBase):
     def get_absolute_url(self):
         return reverse("event_rule_security_problem", args=(self.site.uid, self.id))
 
+    @staticmethod
+    def get_executable_codes(security_problems):
+        """Return a dict mapping the id of each security problem to the code of
+        its security script, with the id of the problem injected.
+
+        The rendered code is cached per problem and script version, so only
+        scripts that changed since the last call are read from storage."""
+        cache_keys = {
+            problem.id: (
+                f"security_problem_code:{problem.id}:"
+                f"{problem.security_script.code_version}"
+            )
+            for problem in security_problems
+        }
+        cached = cache.get_many(cache_keys.values())
+
+        codes = {}
+        missing = {}
+        for problem in security_problems:
+            cache_key = cache_keys[problem.id]
+            if cache_key in cached:
+                codes[problem.id] = cached[cache_key]
+            else:
+                # SECURITY_PROBLEM_UID is used by the client to pair
+                # SecurityEvents with SecurityProblems
+                codes[problem.id] = missing[
+                    cache_key
+                ] = problem.security_script.get_executable_code().replace(
+                    "%SECURITY_PROBLEM_UID%", str(problem.id)
+                )
+        if missing:
+            cache.set_many(missing, Script.CODE_CACHE_TIMEOUT)
+        return codes
+
 
 class EventRuleServer(EventRuleBase):
     """A model representing a different type of SecurityProblem. A regular SecurityProblem is a script sent to the
@@ -1411,6 +2056,9 @@ class SecurityEvent(models.Model):
         on_delete=models.SET_NULL,
     )
     note = models.TextField(blank=True)
+    # Bulk updates must set this explicitly, see the incremental sync in
+    # system.api
+    modified = models.DateTimeField(verbose_name=_("modified"), auto_now=True)
 
     @property
     def namestr(self):
@@ -1430,6 +2078,66 @@ class SecurityEvent(models.Model):
                 name="problem_or_rule_set",
             ),
         ]
+        indexes = [
+            # Events from event rules on a PC, see monitoring.get_offline_pcs
+            models.Index(
+                fields=["event_rule_server", "pc", "reported_time"],
+                condition=Q(event_rule_server__isnull=False),
+                name="securityevent_rule_pc_idx",
+            ),
+            # Events with a given status in a given period, see api.list_events
+            models.Index(
+                fields=["status", "occurred_time"],
+                name="securityevent_status_time_idx",
+            ),
+            # Events changed since a given time, see api.list_events
+            models.Index(fields=["modified", "id"], name="securityevent_modified_idx"),
+        ]
+
+
+class Notification(models.Model):
+    """An e-mail notification to a single recipient.
+
+    Notifications are not sent right away, but collected in this outbox and
+    sent in batches by system.notifications.dispatch_notifications, so
+    a burst of notifications for a recipient results in a single e-mail."""
+
+    PENDING = "PENDING"
+    SENT = "SENT"
+    FAILED = "FAILED"
+
+    STATUS_CHOICES = (
+        (PENDING, _("Pending")),
+        (SENT, _("Sent")),
+        (FAILED, _("Failed")),
+    )
+
+    recipient = models.EmailField(verbose_name=_("recipient"))
+    subject = models.CharField(verbose_name=_("subject"), max_length=998)
+    body = models.TextField(verbose_name=_("body"))
+    status = models.CharField(
+        verbose_name=_("status"),
+        max_length=10,
+        choices=STATUS_CHOICES,
+        default=PENDING,
+    )
+    created = models.DateTimeField(
+        verbose_name=_("created"), default=timezone.now, editable=False
+    )
+    sent_time = models.DateTimeField(verbose_name=_("sent"), null=True, blank=True)
+    error = models.TextField(verbose_name=_("error"), blank=True)
+
+    def __str__(self):
+        return "{0}: {1}".format(self.recipient, self.subject)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["recipient", "created"],
+                condition=Q(status="PENDING"),
+                name="notification_pending_idx",
+            ),
+        ]
 
 
 class ImageVersion(models.Model):
@@ -1485,5 +2193,46 @@ class APIKey(models.Model):
     )
     site = models.ForeignKey(Site, related_name="apikeys", on_delete=models.CASCADE)
 
+    # Kept short, as changes made with QuerySet.update() don't invalidate the
+    # cached site
+    SITE_CACHE_TIMEOUT = 60
+
+    @staticmethod
+    def get_cache_key(key):
+        return "apikey_site:" + hashlib.sha256(key.encode()).hexdigest()
+
+    @classmethod
+    def get_site(cls, key):
+        """Return the site of the API key, or None if the key is invalid."""
+        cache_key = cls.get_cache_key(key)
+        site = cache.get(cache_key)
+        if site is None:
+            api_key = cls.objects.select_related("site").filter(key=key).first()
+            if api_key is None:
+                return None
+            site = api_key.site
+            cache.set(cache_key, site, cls.SITE_CACHE_TIMEOUT)
+        return site
+
+    def save(self, *args, **kwargs):
+        cache_keys = [self.get_cache_key(self.key)]
+        if self.pk is not None:
+            # The key itself may have been changed
+            cache_keys.extend(
+                self.get_cache_key(key)
+                for key in APIKey.objects.filter(pk=self.pk).values_list(
+                    "key", flat=True
+                )
+            )
+        super().save(*args, **kwargs)
+        cache.delete_many(cache_keys)
+
     def __str__(self):
         return self.key
+
+
+@receiver(post_delete, sender=APIKey)
+def invalidate_api_key_site(sender, instance, **kwargs):
+    """Revoke deleted API keys right away, including keys deleted in bulk or
+    along with their site."""
+    cache.delete(APIKey.get_cache_key(instance.key))
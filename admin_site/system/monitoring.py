@@ -0,0 +1,232 @@
+"""Evaluation of server side event rules, i.e. EventRuleServers.
+
+Each rule is evaluated with a single query that finds the PCs that have been
+offline for longer than allowed and don't already have an event for the
+current offline period. The events are created in bulk and the recipients of
+the notifications are looked up in bulk as well. The notifications are added
+to the outbox, to be sent by system.notifications.dispatch_notifications.
+
+OfflineMonitor is used by the long-running notification worker. It keeps the
+rules in memory and, between occasional full scans, only looks at the PCs
+that have passed their rule's maximum offline period since the last check."""
+
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+
+from system import heartbeat
+from system.models import PC, EventRuleServer, SecurityEvent
+from system.notifications import get_supervisor_emails, queue_notifications
+
+
+def has_recent_check_ins(now):
+    """Return whether any PC has checked in within the last ten minutes. If
+    none have, the server itself has likely been unreachable, and the PCs
+    shouldn't be reported as offline. Check-ins are flushed to the database
+    well within this window."""
+    return PC.objects.filter(last_seen__gte=now - timedelta(seconds=600)).exists()
+
+
+def is_monitoring(rule, now):
+    return rule.monitor_period_start < now.time() < rule.monitor_period_end
+
+
+def get_offline_pcs(rule, now, checked_since=None):
+    """Return the PCs covered by the rule that have been offline for longer
+    than allowed and that have no event from the rule since they were last
+    seen. The rule's alert groups are expected to be prefetched.
+
+    If checked_since is given, only PCs that have passed the maximum offline
+    period after that time are considered."""
+    offline_period = timedelta(minutes=rule.maximum_offline_period)
+    offline_since = now - offline_period
+
+    alert_groups = rule.alert_groups.all()
+    if alert_groups:
+        pcs = PC.objects.filter(
+            pk__in=PC.pc_groups.through.objects.filter(pcgroup__in=alert_groups).values(
+                "pc"
+            )
+        )
+    else:
+        pcs = PC.objects.filter(site=rule.site_id)
+
+    pcs = pcs.filter(last_seen__lt=offline_since)
+    if checked_since is not None:
+        # The stored last_seen may lag the cached one by the flush interval,
+        # see system.heartbeat.
+        flush_interval = timedelta(seconds=settings.HEARTBEAT_FLUSH_INTERVAL)
+        pcs = pcs.filter(last_seen__gte=checked_since - offline_period - flush_interval)
+
+    pcs = list(
+        pcs.exclude(
+            Exists(
+                SecurityEvent.objects.filter(
+                    pc=OuterRef("pk"),
+                    event_rule_server=rule,
+                    reported_time__gte=OuterRef("last_seen"),
+                )
+            )
+        )
+        .only("name", "last_seen")
+        .order_by("name")
+    )
+
+    # Leave out PCs that have checked in since last_seen was last written
+    last_seen = heartbeat.last_seen_many(pcs)
+    return [pc for pc in pcs if last_seen[pc.pk] < offline_since]
+
+
+def make_offline_messages(rule, pcs):
+    """Return the e-mails notifying about the offline PCs. The supervisors of
+    a PC's groups are notified, or the rule's alert users if it has none."""
+    supervisors = get_supervisor_emails([pc.pk for pc in pcs])
+    alert_users = None
+
+    email_dict = {}
+    for pc in pcs:
+        emails = supervisors.get(pc.pk)
+        if not emails:
+            if alert_users is None:
+                alert_users = set(rule.alert_users.values_list("email", flat=True))
+            emails = alert_users
+        for email in emails:
+            try:
+                email_dict[email] += ", " + pc.name
+            except KeyError:
+                email_dict[email] = pc.name
+
+    email_lists = defaultdict(list)
+    for email, pc_names in email_dict.items():
+        email_lists[pc_names].append(email)
+
+    messages = []
+    for pc_names, email_list in email_lists.items():
+        body = "Notification:\n"
+        body += (
+            f"The computer(s) {pc_names} have been offline for longer than "
+            f"{rule.maximum_offline_period} minutes"
+        )
+        messages.append(
+            EmailMessage(f"Notification rule: {rule.name}", body, to=email_list)
+        )
+    return messages
+
+
+def check_offline_rules(rules, now, checked_since=None):
+    """Create offline events and queue notifications for the rules that are
+    within their monitoring period.
+
+    checked_since optionally maps rule ids to when the rule was last checked,
+    so only PCs that have gone offline since then are considered.
+
+    Returns a dict of statistics about the run."""
+    if checked_since is None:
+        checked_since = {}
+    stats = {"rules": 0, "events": 0, "notifications": 0}
+    messages = []
+
+    for rule in rules:
+        if not is_monitoring(rule, now):
+            continue
+        stats["rules"] += 1
+
+        with transaction.atomic():
+            # The rule is locked, as the notification worker and the
+            # check_notifications cron job may check it at the same time, and
+            # must not both create events for the same PCs
+            list(
+                EventRuleServer.objects.select_for_update()
+                .filter(pk=rule.pk)
+                .values_list("pk")
+            )
+            offline_pcs = get_offline_pcs(rule, now, checked_since.get(rule.pk))
+            if not offline_pcs:
+                continue
+
+            SecurityEvent.objects.bulk_create(
+                SecurityEvent(
+                    event_rule_server=rule,
+                    pc=pc,
+                    occurred_time=now,
+                    reported_time=now,
+                    summary=(
+                        f"The Computer {pc.name} was offline for longer than "
+                        f"{rule.maximum_offline_period} minutes"
+                    ),
+                )
+                for pc in offline_pcs
+            )
+        stats["events"] += len(offline_pcs)
+        messages.extend(make_offline_messages(rule, offline_pcs))
+
+    stats["notifications"] = len(queue_notifications(messages))
+
+    return stats
+
+
+class OfflineMonitor:
+    """Checks the offline rules incrementally on each call to check().
+
+    The rules are reloaded every rule_refresh_interval. A rule is scanned in
+    full the first time it is checked, when its monitoring period starts and
+    when its settings change, as well as every full_scan_interval to pick up
+    any PCs missed along the way."""
+
+    def __init__(
+        self,
+        rule_refresh_interval=timedelta(minutes=5),
+        full_scan_interval=timedelta(hours=1),
+    ):
+        self.rule_refresh_interval = rule_refresh_interval
+        self.full_scan_interval = full_scan_interval
+        self.rules = []
+        self.rules_loaded = None
+        self.last_full_scan = None
+        # Maps the state of each rule to when it was last checked
+        self.checked = {}
+
+    def load_rules(self, now):
+        self.rules = list(EventRuleServer.objects.prefetch_related("alert_groups"))
+        self.rules_loaded = now
+
+    @staticmethod
+    def get_rule_state(rule):
+        return (
+            rule.pk,
+            rule.site_id,
+            rule.maximum_offline_period,
+            tuple(sorted(group.pk for group in rule.alert_groups.all())),
+        )
+
+    def check(self, now):
+        if (
+            self.rules_loaded is None
+            or now - self.rules_loaded >= self.rule_refresh_interval
+        ):
+            self.load_rules(now)
+
+        full_scan = (
+            self.last_full_scan is None
+            or now - self.last_full_scan >= self.full_scan_interval
+        )
+        if full_scan:
+            self.last_full_scan = now
+            self.checked = {}
+
+        checked_since = {}
+        checked = {}
+        for rule in self.rules:
+            if is_monitoring(rule, now):
+                state = self.get_rule_state(rule)
+                checked_since[rule.pk] = self.checked.get(state)
+                checked[state] = now
+
+        stats = check_offline_rules(self.rules, now, checked_since)
+        self.checked = checked
+        stats["full_scan"] = full_scan
+        return stats
@@ -0,0 +1,204 @@
+"""E-mail notifications about security events and offline PCs.
+
+Notifications are not sent while handling a request or checking rules, but
+added to an outbox, the Notification model. dispatch_notifications sends them
+in batches: all pending notifications for a recipient are combined into one
+e-mail once the oldest has waited for NOTIFICATION_DIGEST_WINDOW seconds, and
+every batch is sent through a single SMTP connection. It is run every minute
+by the dispatch_notifications cron job, and after every check by the
+notification worker where that is deployed."""
+
+import logging
+import traceback
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import Min
+
+from system.models import Notification, PCGroup, SecurityProblem
+
+logger = logging.getLogger(__name__)
+
+
+def queue_notifications(messages):
+    """Add a notification for each recipient of each of the e-mail messages
+    to the outbox."""
+    return Notification.objects.bulk_create(
+        Notification(recipient=email, subject=message.subject, body=message.body)
+        for message in messages
+        for email in message.to
+        if email
+    )
+
+
+def notify_security_events(security_events):
+    """Queue notifications about the security events. The events must have
+    their problem and PC set."""
+    security_events = [
+        security_event
+        for security_event in security_events
+        if security_event.problem_id is not None
+    ]
+    return queue_notifications(
+        make_security_event_message(events, [email])
+        for email, events in get_security_event_recipients(security_events).items()
+    )
+
+
+def get_supervisor_emails(pc_ids):
+    """Return a dict mapping the ids of the PCs to the e-mail addresses of the
+    supervisors of their groups, for PCs that have any."""
+    supervisors = defaultdict(set)
+    for pc_id, email in PCGroup.supervisors.through.objects.filter(
+        pcgroup__pcs__in=pc_ids
+    ).values_list("pcgroup__pcs", "user__email"):
+        supervisors[pc_id].add(email)
+    return supervisors
+
+
+def get_security_event_recipients(security_events):
+    """Return a dict mapping e-mail addresses to the security events their
+    owners should be notified about.
+
+    The supervisors of a PC's groups are notified about its events. If the PC
+    has no supervisors, the alert users of the security problem are."""
+    supervisors = get_supervisor_emails(
+        {security_event.pc_id for security_event in security_events}
+    )
+    problem_ids = {security_event.problem_id for security_event in security_events}
+
+    alert_users = defaultdict(set)
+    for problem_id, email in SecurityProblem.alert_users.through.objects.filter(
+        securityproblem__in=problem_ids
+    ).values_list("securityproblem", "user__email"):
+        alert_users[problem_id].add(email)
+
+    recipients = defaultdict(list)
+    for security_event in security_events:
+        emails = supervisors.get(security_event.pc_id) or alert_users.get(
+            security_event.problem_id, set()
+        )
+        for email in emails:
+            if email:
+                recipients[email].append(security_event)
+    return recipients
+
+
+def make_security_event_message(security_events, email_list):
+    if len(security_events) == 1:
+        security_event = security_events[0]
+        subject = (
+            f"Sikkerhedsadvarsel for PC : {security_event.pc.name}."
+            f" Sikkerhedsregel : {security_event.problem.name}"
+        )
+        body = (
+            "Beskrivelse af sikkerhedsadvarsel: "
+            f"{security_event.problem.description}\n"
+            f"Kort resume af data fra log filen : {security_event.summary}"
+        )
+    else:
+        pc_names = sorted(
+            {security_event.pc.name for security_event in security_events}
+        )
+        subject = f"{len(security_events)} sikkerhedsadvarsler for PC : " + ", ".join(
+            pc_names
+        )
+        body = "\n\n".join(
+            f"PC : {security_event.pc.name}."
+            f" Sikkerhedsregel : {security_event.problem.name}\n"
+            "Beskrivelse af sikkerhedsadvarsel: "
+            f"{security_event.problem.description}\n"
+            f"Kort resume af data fra log filen : {security_event.summary}"
+            for security_event in security_events
+        )
+    return EmailMessage(subject, body, settings.DEFAULT_FROM_EMAIL, email_list)
+
+
+def make_digest_message(notifications):
+    if len(notifications) == 1:
+        subject = notifications[0].subject
+        body = notifications[0].body
+    else:
+        subject = f"{len(notifications)} notifikationer fra OS2borgerPC"
+        body = "\n\n----------\n\n".join(
+            f"{notification.subject}\n\n{notification.body}"
+            for notification in notifications
+        )
+    return EmailMessage(
+        subject, body, settings.DEFAULT_FROM_EMAIL, [notifications[0].recipient]
+    )
+
+
+def dispatch_notifications(now=None):
+    """Send the pending notifications of every recipient whose oldest pending
+    notification has waited for the digest window, one e-mail per recipient.
+
+    Returns the number of e-mails sent."""
+    if now is None:
+        now = datetime.now()
+    window = timedelta(seconds=settings.NOTIFICATION_DIGEST_WINDOW)
+
+    due_recipients = (
+        Notification.objects.filter(status=Notification.PENDING)
+        .values("recipient")
+        .annotate(first_created=Min("created"))
+        .filter(first_created__lte=now - window)
+        .values("recipient")
+    )
+    # Lock the notifications while sending, so concurrent dispatchers don't
+    # send them twice
+    with transaction.atomic():
+        pending = defaultdict(list)
+        for notification in (
+            Notification.objects.select_for_update(skip_locked=True)
+            .filter(
+                status=Notification.PENDING,
+                recipient__in=due_recipients,
+                created__lte=now,
+            )
+            .order_by("pk")
+        ):
+            pending[notification.recipient].append(notification)
+        if not pending:
+            return 0
+        return send_digests(pending.values(), now)
+
+
+def send_digests(notification_lists, now):
+    """Send each list of notifications as one e-mail through a single SMTP
+    connection and record the outcome. Returns the number of e-mails sent."""
+    connection = get_connection(fail_silently=False)
+    try:
+        connection.open()
+    except Exception:  # Likely Exception: SMTPException
+        # Leave the notifications pending, to be retried on the next dispatch
+        logger.warning("Notification e-mail-sending failed:")
+        logger.warning(traceback.format_exc())
+        return 0
+
+    sent = []
+    sent_count = 0
+    try:
+        for notifications in notification_lists:
+            try:
+                connection.send_messages([make_digest_message(notifications)])
+            except Exception:  # Likely Exception: SMTPException
+                error = traceback.format_exc()
+                logger.warning("Notification e-mail-sending failed:")
+                logger.warning(error)
+                Notification.objects.filter(
+                    pk__in=[notification.pk for notification in notifications]
+                ).update(status=Notification.FAILED, error=error)
+            else:
+                sent.extend(notification.pk for notification in notifications)
+                sent_count += 1
+    finally:
+        connection.close()
+
+    Notification.objects.filter(pk__in=sent).update(
+        status=Notification.SENT, sent_time=now
+    )
+    return sent_count
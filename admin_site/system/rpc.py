@@ -1,18 +1,20 @@
 # This module contains the implementation of the XML-RPC API used by the
 # client.
 
-import system.utils
+from system import heartbeat, notifications
 import hashlib
+import json
 import logging
 from datetime import datetime, timedelta
 
 from django.conf import settings
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import Prefetch, Q
 
-from system.models import PC, Site, Configuration, ConfigurationEntry
-from system.models import Job, SecurityProblem, SecurityEvent
-from system.models import Citizen, LoginLog
-from system.models import Product
+from system.models import PC, Site, Configuration
+from system.models import BatchParameter, Job, SecurityProblem, SecurityEvent
+from system.models import Citizen, LoginCount, LoginLog
+from system.models import Product, SiteStatistics
 
 from system.utils import (
     get_citizen_login_api_validator,
@@ -54,17 +56,10 @@ def register_new_computer_v2(mac, name, site, configuration):
     # Create new configuration, populate with data from computer's config.
     # If a configuration with the same ID is hanging, reuse.
     config_name = "_".join([site, name, uid])
-    try:
-        my_config = Configuration.objects.get(name=config_name)
-    except Configuration.DoesNotExist:
-        my_config = Configuration()
-        my_config.name = config_name
-    finally:
+    my_config, created = Configuration.objects.get_or_create(name=config_name)
+    if not created:
         # Delete pre-existing entries
-        entries = ConfigurationEntry.objects.filter(owner_configuration=my_config)
-        for e in entries:
-            e.delete()
-    my_config.save()
+        my_config.entries.all().delete()
     # And load configuration
 
     # Update configuration with os2 product
@@ -92,9 +87,7 @@ def register_new_computer_v2(mac, name, site, configuration):
     except KeyError:
         pass
 
-    for k, v in list(configuration.items()):
-        entry = ConfigurationEntry(key=k, value=v, owner_configuration=my_config)
-        entry.save()
+    my_config.update_entries(configuration)
     # Set and save PmC
     new_pc.configuration = my_config
     new_pc.save()
@@ -118,25 +111,32 @@ def send_status_info_v2(pc_uid, job_data):
         # Fail silently
         return 0
 
-    pc.last_seen = datetime.now()
-    pc.save()
+    heartbeat.record(pc)
 
     # 2. Update jobs with job data
-    if job_data is not None:
+    if job_data:
+        # Only jobs belonging to the reporting PC may be updated
+        jobs = (
+            Job.objects.filter(pc=pc)
+            .only("started", "finished")
+            .in_bulk([jd["id"] for jd in job_data])
+        )
+        now = datetime.now()
         for jd in job_data:
-            job = Job.objects.filter(pk=jd["id"]).first()
+            job = jobs.get(int(jd["id"]))
             if not job:
                 continue
             job.status = jd["status"]
+            job.modified = now
             # Empty strings might be sent in rare cases, which otherwise cause validation errors
             if jd["started"]:
                 job.started = jd["started"]
             if jd["finished"]:
                 job.finished = jd["finished"]
             job.log_output = jd["log_output"]
-            job.save()
-
-    pc.save()
+        Job.objects.bulk_update(
+            jobs.values(), ["status", "started", "finished", "log_output", "modified"]
+        )
 
     return 0
 
@@ -146,11 +146,9 @@ def send_status_info(pc_uid, package_data, job_data, update_required):
     return send_status_info_v2(pc_uid, job_data)
 
 
-def get_instructions(pc_uid):
-    """This function will ask for new instructions in the form of a list of
-    jobs, which will be scheduled for execution and executed upon receipt.
-    These jobs will generally take the form of bash scripts."""
-
+def get_activated_pc_for_instructions(pc_uid):
+    """Look up the PC asking for instructions and register that it has been
+    seen. Returns None if the PC has not been activated yet."""
     try:
         pc = PC.objects.get(uid=pc_uid)
     except PC.DoesNotExist:
@@ -158,53 +156,168 @@ def get_instructions(pc_uid):
             "This Computer does not appear to be registered with the configured admin portal."
         )
 
-    pc.last_seen = datetime.now()
-    pc.save()
+    heartbeat.record(pc)
 
     if not pc.is_activated:
-        # Fail silently
-        return {}
+        return None
+    return pc
+
+
+def claim_jobs(pc):
+    """Mark the PC's new jobs as submitted and return them as instructions.
+
+    Jobs locked by a concurrent poll from the same PC are skipped, so a job
+    is never handed out twice."""
+    with transaction.atomic():
+        job_ids = list(
+            pc.jobs.select_for_update(skip_locked=True)
+            .filter(status=Job.NEW)
+            .values_list("pk", flat=True)
+        )
+        Job.objects.filter(pk__in=job_ids).update(
+            status=Job.SUBMITTED, modified=datetime.now()
+        )
+
+    jobs = (
+        Job.objects.filter(pk__in=job_ids)
+        .select_related("batch__script")
+        .prefetch_related(
+            Prefetch(
+                "batch__parameters",
+                queryset=BatchParameter.objects.select_related("input"),
+            )
+        )
+        .order_by("pk")
+    )
+    return [job.as_instruction for job in jobs]
 
-    jobs = []
-    for job in pc.jobs.filter(status=Job.NEW).order_by("pk"):
-        job.status = Job.SUBMITTED
-        job.save()
-        jobs.append(job.as_instruction)
 
-    # Check for security scripts covering the site and
-    # security scripts covering groups the pc is a member of.
-    security_problems = SecurityProblem.objects.filter(
-        Q(site=pc.site, alert_groups__isnull=True)
-        | Q(alert_groups__in=pc.pc_groups.all())
-    ).select_related("security_script")
+def get_security_problems(pc):
+    """Return the security problems covering the site and the security
+    problems covering groups the pc is a member of."""
+    return list(
+        SecurityProblem.objects.filter(
+            Q(site=pc.site, alert_groups__isnull=True)
+            | Q(alert_groups__in=pc.pc_groups.all())
+        ).select_related("security_script")
+    )
+
+
+def get_security_script_name(security_problem):
+    # "name" will be used as part of the script name on the client, whereas SECURITY_PROBLEM_UID is used internally to
+    # pair SecurityProblems with SecurityEvents
+    return f"script{security_problem.security_script.id}_problem{security_problem.id}"
+
+
+def get_security_scripts(pc, security_problems=None):
+    """Return the security scripts covering the site and the security
+    scripts covering groups the pc is a member of."""
+    if security_problems is None:
+        security_problems = get_security_problems(pc)
+    executable_codes = SecurityProblem.get_executable_codes(security_problems)
 
     scripts = []
 
     for security_problem in security_problems:
-        # inject security problem uid into the script code.
-        # "name" will be used as part of the script name on the client, whereas SECURITY_PROBLEM_UID is used internally to
-        # pair SecurityProblems with SecurityEvents
-        identifier = (
-            f"script{security_problem.security_script.id}_problem{security_problem.id}"
-        )
         script_dict = {
-            "name": identifier,
-            "executable_code": security_problem.security_script.executable_code.read()
-            .decode("utf8")
-            .replace("%SECURITY_PROBLEM_UID%", str(security_problem.id)),
+            "name": get_security_script_name(security_problem),
+            "executable_code": executable_codes[security_problem.id],
         }
         scripts.append(script_dict)
 
+    return scripts
+
+
+def get_content_hash(content):
+    """Hash used by get_instructions_v2 to tell whether the client already has
+    the current version of a security script or the configuration.
+
+    The content hashed is the version of what is sent rather than the
+    content itself, so the scripts and configuration only have to be loaded
+    when they changed."""
+    return hashlib.sha256(json.dumps(content).encode("utf-8")).hexdigest()
+
+
+def get_instructions(pc_uid):
+    """This function will ask for new instructions in the form of a list of
+    jobs, which will be scheduled for execution and executed upon receipt.
+    These jobs will generally take the form of bash scripts."""
+
+    pc = get_activated_pc_for_instructions(pc_uid)
+    if not pc:
+        # Fail silently
+        return {}
+
     instructions = {
-        "security_scripts": scripts,
-        "jobs": jobs,
+        "security_scripts": get_security_scripts(pc),
+        "jobs": claim_jobs(pc),
         "configuration": pc.get_full_config(),
     }
 
     return instructions
 
 
+def get_instructions_v2(pc_uid, script_hashes, configuration_hash):
+    """Like get_instructions, except that security scripts and configuration
+    are only sent if they differ from what the client already has.
+
+    script_hashes maps the names of the security scripts held by the client to
+    the hashes of their code, and configuration_hash is the hash of the
+    configuration held by the client, both as previously returned by this
+    function.
+
+    Return values:
+        jobs: New jobs, as in get_instructions.
+        security_scripts: The security scripts that are new or changed, each
+                          with a name, executable_code and hash.
+        removed_security_scripts: The names of security scripts held by the
+                                  client that no longer apply to it.
+        configuration: The full configuration, only present if it changed.
+        configuration_hash: The hash of the current configuration."""
+
+    pc = get_activated_pc_for_instructions(pc_uid)
+    if not pc:
+        # Fail silently
+        return {}
+
+    script_hashes = script_hashes or {}
+
+    # The rendered code of a security script only depends on the problem and
+    # the version of the script, see SecurityProblem.get_executable_codes
+    changed_problems = []
+    script_hashes_now = {}
+    for security_problem in get_security_problems(pc):
+        name = get_security_script_name(security_problem)
+        script_hashes_now[name] = get_content_hash(
+            [security_problem.id, security_problem.security_script.code_version]
+        )
+        if script_hashes.get(name) != script_hashes_now[name]:
+            changed_problems.append(security_problem)
+    scripts = get_security_scripts(pc, changed_problems)
+    for script in scripts:
+        script["hash"] = script_hashes_now[script["name"]]
+
+    # The configuration only changes with the versions of the configurations
+    # it is merged from, see PC.get_cached_config, or the PC's own fields
+    instructions = {
+        "security_scripts": scripts,
+        "removed_security_scripts": sorted(set(script_hashes) - set(script_hashes_now)),
+        "jobs": claim_jobs(pc),
+        "configuration_hash": get_content_hash(
+            [pc.get_config_versions(), pc.mac, pc.uid]
+        ),
+    }
+    if instructions["configuration_hash"] != configuration_hash:
+        instructions["configuration"] = pc.get_full_config()
+
+    return instructions
+
+
 def push_config_keys(pc_uid, config_dict):
+    """Store configuration values reported by the client.
+
+    The values are compared with the stored configuration, and only the keys
+    that actually changed are written. Returns the number of changed keys."""
     try:
         pc = PC.objects.get(uid=pc_uid)
     except PC.DoesNotExist:
@@ -216,29 +329,51 @@ def push_config_keys(pc_uid, config_dict):
 
     # We need two config dicts: one from the PC itself and one from groups
     # and global configuration
-    config_lists = pc.get_list_of_configurations()
-
-    pc_config_list = config_lists.pop()
-
     pc_config = {}
-    for entry in pc_config_list.entries.all():
-        pc_config[entry.key] = entry.value
-
     others_config = {}
-    for conf in config_lists:
-        for entry in conf.entries.all():
-            others_config[entry.key] = entry.value
+    for key, value, layer in pc.get_config_entries().values_list(
+        "key", "value", "layer"
+    ):
+        if layer == PC.CONFIG_LAYER_PC:
+            pc_config[key] = value
+        else:
+            others_config[key] = value
 
+    to_upsert = {}
+    to_remove = []
     for key, value in list(config_dict.items()):
         # Special case: If the value we want is in others_config, we just have
         # to remove any pc-specific config:
         if key in others_config and others_config[key] == value:
             if key in pc_config:
-                pc.configuration.remove_entry(key)
-        else:
-            pc.configuration.update_entry(key, value)
+                to_remove.append(key)
+        elif key not in pc_config or pc_config[key] != value:
+            to_upsert[key] = value
+
+    changed = len(to_upsert) + len(to_remove)
+    if changed:
+        configuration = Configuration(pk=pc.configuration_id)
+        with transaction.atomic():
+            configuration.entries.filter(key__in=to_remove).delete()
+            configuration.update_entries(to_upsert)
+            if "login_counts" in to_upsert or "login_counts" in to_remove:
+                LoginCount.store(pc.pk, config_dict["login_counts"])
+            # The API exposes some of the configuration as fields of the PC
+            PC.objects.filter(pk=pc.pk).update(modified=datetime.now())
+
+        changed_keys = set(to_upsert).union(to_remove)
+        if changed_keys.intersection(["os2_product", "_os_release"]):
+            new_pc_config = {
+                key: value for key, value in pc_config.items() if key not in to_remove
+            }
+            new_pc_config.update(to_upsert)
+            SiteStatistics.apply_change(
+                pc.site_id,
+                removed=SiteStatistics.get_counters(pc.is_activated, pc_config),
+                added=SiteStatistics.get_counters(pc.is_activated, new_pc_config),
+            )
 
-    return True
+    return changed
 
 
 # TODO: Log events for SecurityProblems that don't exist
@@ -248,6 +383,7 @@ def push_config_keys(pc_uid, config_dict):
 def push_security_events(pc_uid, events_csv):
     pc = PC.objects.get(uid=pc_uid)
 
+    parsed_events = []
     for event in events_csv:
         event_split = event.split(",")
         if len(event_split) == 3 or len(event_split) == 4:
@@ -265,7 +401,7 @@ def push_security_events(pc_uid, events_csv):
             continue
 
         try:
-            security_problem = SecurityProblem.objects.filter(id=rule_id).first()
+            rule_id = int(rule_id)
         except ValueError:
             if settings.DEBUG or "test" in settings.SERVER_EMAIL:
                 logger.exception(
@@ -276,11 +412,33 @@ def push_security_events(pc_uid, events_csv):
                 )
             continue
 
+        try:
+            event_date = datetime.strptime(event_date, "%Y%m%d%H%M%S")
+        except ValueError:
+            if settings.DEBUG or "test" in settings.SERVER_EMAIL:
+                logger.exception(
+                    "Security event log contained invalid date %s, Event: %s, PC UID %s",
+                    event_date,
+                    str(event),
+                    pc.uid,
+                )
+            continue
+
+        parsed_events.append((event, event_date, rule_id, event_summary))
+
+    security_problems = SecurityProblem.objects.in_bulk(
+        {rule_id for _, _, rule_id, _ in parsed_events}
+    )
+
+    now = datetime.now()
+    security_events = []
+    for event, event_date, rule_id, event_summary in parsed_events:
+        security_problem = security_problems.get(rule_id)
         if not security_problem:
             # Ignore ID's of SecurityProblems that don't exist
             continue
 
-        if not security_problem.site == pc.site:
+        if not security_problem.site_id == pc.site_id:
             # Ignore SecurityProblems matching a computer on a different site
             logger.error(
                 (
@@ -293,22 +451,20 @@ def push_security_events(pc_uid, events_csv):
             )
             continue
 
-        now = datetime.now()
-        event_occurred_time_object = datetime.strptime(event_date, "%Y%m%d%H%M%S")
-        security_event = SecurityEvent.objects.create(
-            problem=security_problem,
-            pc=pc,
-            occurred_time=event_occurred_time_object,
-            reported_time=now,
-            summary=event_summary,
+        security_events.append(
+            SecurityEvent(
+                problem=security_problem,
+                pc=pc,
+                occurred_time=event_date,
+                reported_time=now,
+                summary=event_summary,
+            )
         )
 
-        # Notify subscribed users
-        system.utils.notify_users(
-            security_event,
-            security_problem,
-            pc,
-        )
+    SecurityEvent.objects.bulk_create(security_events)
+
+    # Queue notifications for the subscribed users
+    notifications.notify_security_events(security_events)
 
     return 0
 
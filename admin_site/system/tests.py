@@ -5,14 +5,43 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import json
 import os
+from datetime import date, datetime, time, timedelta
+from unittest import mock
 
 from django.conf import settings
-from django.test import TestCase
+from django.core import mail
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, connection
+from django.http import QueryDict
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 
 from django.core.mail import EmailMessage
 from django.contrib.auth.models import User
 from account.models import UserProfile
+from system import heartbeat, login_statistics, monitoring, notifications, rpc
+from system.models import (
+    APIKey,
+    Configuration,
+    ConfigurationEntry,
+    EventRuleServer,
+    Input,
+    Job,
+    LoginLog,
+    Notification,
+    PC,
+    PCGroup,
+    Script,
+    SecurityEvent,
+    SecurityProblem,
+    Site,
+    SiteStatistics,
+)
 
 print("FILE", os.path.dirname(__file__))
 
@@ -53,3 +82,914 @@ class SimpleTest(TestCase):
 
         self.assertEqual(len(email_list), 2)
         self.assertEqual(message.send(), 1)
+
+
+class HeartbeatTest(TestCase):
+    def setUp(self):
+        site = Site.objects.create(name="Test", uid="test")
+        self.pc = PC.objects.create(
+            name="pc",
+            uid="pc",
+            site=site,
+            configuration=Configuration.objects.create(name="pc"),
+        )
+
+    def test_record_writes_through_once_per_interval(self):
+        now = datetime.now()
+        with self.assertNumQueries(1):
+            self.assertTrue(heartbeat.record(self.pc, now))
+        self.pc.refresh_from_db()
+        self.assertEqual(self.pc.last_seen, now)
+
+        later = now + timedelta(seconds=settings.HEARTBEAT_FLUSH_INTERVAL - 1)
+        with self.assertNumQueries(0):
+            self.assertFalse(heartbeat.record(self.pc, later))
+        self.pc.refresh_from_db()
+        self.assertEqual(self.pc.last_seen, now)
+        self.assertEqual(heartbeat.last_seen(self.pc), later)
+
+        later = now + timedelta(seconds=settings.HEARTBEAT_FLUSH_INTERVAL)
+        self.assertTrue(heartbeat.record(self.pc, later))
+        self.pc.refresh_from_db()
+        self.assertEqual(self.pc.last_seen, later)
+
+    def test_online_and_offline_querysets(self):
+        self.assertEqual(PC.objects.online().count(), 0)
+        self.assertEqual(PC.objects.offline().count(), 1)
+
+        now = datetime.now()
+        PC.objects.update(last_seen=now - timedelta(minutes=4))
+        self.assertEqual(list(self.pc.site.pcs.online(now)), [self.pc])
+        self.assertEqual(PC.objects.offline(now + timedelta(minutes=2)).count(), 1)
+
+
+class ConfigurationResolutionTest(TestCase):
+    def setUp(self):
+        site = Site.objects.create(name="Test", uid="test")
+        self.pc = PC.objects.create(
+            name="pc",
+            uid="pc",
+            site=site,
+            configuration=Configuration.objects.create(name="pc"),
+        )
+        group_a = PCGroup.objects.create(name="a", site=site)
+        group_b = PCGroup.objects.create(name="b", site=site)
+        self.pc.pc_groups.add(group_a, group_b)
+
+        site.configuration.update_entry("key", "site")
+        site.configuration.update_entry("site_only", "site")
+        group_a.configuration.update_entry("key", "a")
+        group_b.configuration.update_entry("key", "b")
+        group_b.configuration.update_entry("list", "x, y")
+        self.pc.configuration.update_entry("list", "y,z")
+
+    def test_layer_precedence(self):
+        with self.assertNumQueries(1):
+            config = self.pc.get_merged_config()
+        self.assertEqual(config["key"], "b")
+        self.assertEqual(config["site_only"], "site")
+        self.assertEqual(config["list"], "y,z")
+
+        self.pc.configuration.update_entry("key", "pc")
+        self.assertEqual(self.pc.get_config_value("key"), "pc")
+        self.assertEqual(self.pc.get_config_value("missing", "default"), "default")
+
+    def test_merged_config_list(self):
+        self.assertEqual(self.pc.get_merged_config_list("list"), ["x", "y", "z"])
+
+    def test_cached_config_is_invalidated(self):
+        self.assertEqual(self.pc.get_cached_config()["key"], "b")
+        with self.assertNumQueries(1):
+            self.assertEqual(self.pc.get_cached_config()["key"], "b")
+
+        group_c = PCGroup.objects.create(name="c", site=self.pc.site)
+        group_c.configuration.update_entry("key", "c")
+        self.pc.pc_groups.add(group_c)
+        self.assertEqual(self.pc.get_cached_config()["key"], "c")
+
+        group_c.configuration.remove_entry("key")
+        self.assertEqual(self.pc.get_cached_config()["key"], "b")
+
+    def test_push_config_keys_only_writes_changes(self):
+        self.pc.is_activated = True
+        self.pc.save()
+        push = {"key": "b", "list": "y,z", "new": "1"}
+        self.assertEqual(rpc.push_config_keys(self.pc.uid, push), 1)
+        self.assertEqual(rpc.push_config_keys(self.pc.uid, push), 0)
+
+        push = {"key": "pc", "list": "x, y", "new": "2"}
+        self.assertEqual(rpc.push_config_keys(self.pc.uid, push), 3)
+        self.assertEqual(
+            dict(self.pc.configuration.entries.values_list("key", "value")),
+            {"key": "pc", "new": "2"},
+        )
+
+    def test_update_entry_upserts(self):
+        with self.assertNumQueries(2):
+            self.pc.configuration.update_entry("list", "a")
+        self.pc.configuration.update_entries({"list": "b", "other": "c"})
+        self.assertEqual(
+            dict(self.pc.configuration.entries.values_list("key", "value")),
+            {"list": "b", "other": "c"},
+        )
+        with self.assertRaises(IntegrityError):
+            ConfigurationEntry.objects.create(
+                owner_configuration=self.pc.configuration, key="list", value="c"
+            )
+
+    def test_update_from_request(self):
+        configuration = self.pc.configuration
+        configuration.update_entries({"a": "1", "b": "2", "c": "3"})
+        a, b, c = configuration.entries.filter(key__in="abc").order_by("key")
+
+        def submit(entries):
+            params = QueryDict(mutable=True)
+            for pk, key, value in entries:
+                pk = str(pk)
+                params.appendlist("pc_config", pk)
+                params.appendlist(f"pc_config_{pk}_key", key)
+                params.appendlist(f"pc_config_{pk}_value", value)
+            configuration.update_from_request(params, "pc_config")
+            return dict(configuration.entries.values_list("key", "value"))
+
+        with self.assertRaises(ValidationError):
+            submit([(a.pk, "b", "1"), (b.pk, "b", "2"), (c.pk, "c", "3")])
+        # Swapped keys, a changed value and a new entry
+        self.assertEqual(
+            submit(
+                [
+                    (a.pk, "b", "1"),
+                    (b.pk, "a", "2"),
+                    (c.pk, "c", "4"),
+                    ("new_0", "d", "5"),
+                ]
+            ),
+            {"a": "2", "b": "1", "c": "4", "d": "5"},
+        )
+        # A new entry replacing a deleted one with the same key
+        self.assertEqual(
+            submit([(c.pk, "c", "4"), ("new_0", "d", "6")]),
+            {"c": "4", "d": "6"},
+        )
+
+    @mock.patch.object(
+        Script, "get_executable_code", return_value="echo %SECURITY_PROBLEM_UID%"
+    )
+    def test_get_instructions_v2_only_sends_changes(self, get_executable_code):
+        self.pc.is_activated = True
+        self.pc.save()
+        script = Script.objects.create(
+            name="script", site=self.pc.site, executable_code="script.sh"
+        )
+        problem = SecurityProblem.objects.create(
+            name="problem", site=self.pc.site, security_script=script
+        )
+        instructions = rpc.get_instructions_v2(self.pc.uid, {"old_script": "x"}, "")
+        self.assertEqual(instructions["configuration"]["key"], "b")
+        self.assertEqual(instructions["removed_security_scripts"], ["old_script"])
+        [security_script] = instructions["security_scripts"]
+        self.assertEqual(security_script["executable_code"], f"echo {problem.id}")
+
+        script_hashes = {security_script["name"]: security_script["hash"]}
+        instructions = rpc.get_instructions_v2(
+            self.pc.uid, script_hashes, instructions["configuration_hash"]
+        )
+        self.assertNotIn("configuration", instructions)
+        self.assertEqual(instructions["security_scripts"], [])
+        self.assertEqual(instructions["removed_security_scripts"], [])
+        self.assertEqual(get_executable_code.call_count, 1)
+
+        # Changing the script or the configuration sends them again
+        script.save()
+        self.pc.configuration.update_entry("key", "pc")
+        instructions = rpc.get_instructions_v2(
+            self.pc.uid, script_hashes, instructions["configuration_hash"]
+        )
+        self.assertEqual(len(instructions["security_scripts"]), 1)
+        self.assertEqual(instructions["configuration"]["key"], "pc")
+
+
+class SiteStatisticsTest(TestCase):
+    def setUp(self):
+        self.site = Site.objects.create(name="Test", uid="test")
+        self.pcs = []
+        for i, (product, release) in enumerate(
+            [
+                ("os2borgerpc", "22.04"),
+                ("os2borgerpc", "20.04"),
+                ("os2borgerpc kiosk", "22.04"),
+            ]
+        ):
+            pc = PC.objects.create(
+                name=f"pc{i}",
+                uid=f"pc{i}",
+                site=self.site,
+                is_activated=i > 0,
+                last_seen=datetime.now(),
+                configuration=Configuration.objects.create(name=f"pc{i}"),
+            )
+            pc.configuration.update_entry("os2_product", product)
+            pc.configuration.update_entry("_os_release", release)
+            self.pcs.append(pc)
+        SiteStatistics.objects.all().delete()
+
+    def test_summarize(self):
+        other_site = Site.objects.create(name="Other", uid="other")
+        # Statistics are computed when missing
+        SiteStatistics.summarize([self.site.pk, other_site.pk])
+        with self.assertNumQueries(1):
+            statistics = SiteStatistics.summarize([self.site.pk, other_site.pk])
+        self.assertEqual(
+            statistics,
+            {
+                "pc_count": 3,
+                "activated_pc_count": 2,
+                "online_pc_count": 3,
+                "borgerpc_count": 2,
+                "borgerpc_kiosk_count": 1,
+                "releases": [("20.04", 1), ("22.04", 2)],
+            },
+        )
+
+    def test_saving_other_fields_skips_statistics(self):
+        pc = PC.objects.only("name").get(pk=self.pcs[0].pk)
+        pc.name = "renamed"
+        with self.assertNumQueries(1):
+            pc.save(update_fields=["name"])
+
+    def test_refreshed_on_changes(self):
+        SiteStatistics.refresh()
+        self.pcs[0].is_activated = True
+        self.pcs[0].save()
+        self.assertEqual(self.site.statistics.activated_pc_count, 3)
+
+        rpc.push_config_keys(self.pcs[1].uid, {"_os_release": "24.04"})
+        self.assertEqual(
+            SiteStatistics.objects.get(site=self.site).releases,
+            {"22.04": 2, "24.04": 1},
+        )
+
+        other_site = Site.objects.create(name="Other", uid="other")
+        SiteStatistics.refresh([other_site.pk])
+        # The old site is known from when the PC was loaded
+        pc = PC.objects.get(pk=self.pcs[2].pk)
+        pc.site = other_site
+        with CaptureQueriesContext(connection) as queries:
+            pc.save()
+        self.assertEqual(
+            len([query for query in queries if query["sql"].startswith("SELECT")]),
+            # The configuration counted in the statistics
+            1,
+        )
+        PC.objects.filter(pk=self.pcs[0].pk).delete()
+        self.assertEqual(
+            SiteStatistics.summarize([self.site.pk]),
+            {
+                "pc_count": 1,
+                "activated_pc_count": 1,
+                "online_pc_count": 1,
+                "borgerpc_count": 1,
+                "borgerpc_kiosk_count": 0,
+                "releases": [("24.04", 1)],
+            },
+        )
+        self.assertEqual(
+            SiteStatistics.summarize([other_site.pk])["borgerpc_kiosk_count"], 1
+        )
+        # The incremental updates agree with recomputing the statistics
+        incremental = SiteStatistics.summarize([self.site.pk, other_site.pk])
+        SiteStatistics.refresh()
+        self.assertEqual(
+            SiteStatistics.summarize([self.site.pk, other_site.pk]), incremental
+        )
+
+
+class JobDispatchTest(TestCase):
+    def setUp(self):
+        self.site = Site.objects.create(name="Test", uid="test")
+        self.pcs = [
+            PC.objects.create(
+                name=f"pc{i}",
+                uid=f"pc{i}",
+                site=self.site,
+                configuration=Configuration.objects.create(name=f"pc{i}"),
+            )
+            for i in range(5)
+        ]
+        self.script = Script.objects.create(
+            name="script", site=self.site, executable_code="script.sh"
+        )
+        cache.clear()
+        patcher = mock.patch.object(
+            Script, "get_executable_code", return_value="echo $1"
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        Input.objects.create(
+            name="arg", value_type=Input.STRING, position=0, script=self.script
+        )
+
+    def test_run_on_creates_jobs_in_bulk(self):
+        site, pcs, script = self.site, self.pcs, self.script
+
+        # Batch, inputs, batch parameters and jobs
+        with self.assertNumQueries(4):
+            batch = script.run_on(site, pcs, "value", user=None)
+
+        self.assertEqual(batch.jobs.count(), 5)
+        self.assertEqual(
+            set(batch.jobs.values_list("log_output", flat=True)),
+            {"New job with arguments [value]"},
+        )
+        self.assertEqual(batch.parameters.get().string_value, "value")
+
+    def test_export_jobs(self):
+        APIKey.objects.create(key="secret", site=self.site)
+        self.script.run_on(self.site, self.pcs, "value", user=None)
+        url = "/api/system/jobs/export"
+
+        response = self.client.get(url, HTTP_AUTHORIZATION="Bearer secret")
+        rows = [json.loads(line) for line in response.streaming_content]
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        self.assertEqual(
+            [row["pc_name"] for row in rows], ["pc4", "pc3", "pc2", "pc1", "pc0"]
+        )
+
+        response = self.client.get(
+            url, {"format": "csv"}, HTTP_AUTHORIZATION="Bearer secret"
+        )
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(
+            lines[0], "id,status,created,modified,started,finished,pc,pc_name"
+        )
+        self.assertEqual(len(lines), 6)
+
+    def test_job_search_query_count(self):
+        superuser = User.objects.create_superuser("admin", "admin@example.com", "x")
+        UserProfile.objects.create(user=superuser)
+        user = User.objects.create(username="user")
+        self.client.force_login(superuser)
+        url = reverse("jobsearch", args=[self.site.uid])
+
+        self.script.run_on(self.site, self.pcs, "value", user=user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, {"page": 1})
+        query_count = len(queries)
+        result = response.json()["results"][0]
+        self.assertEqual(result["pc_url"], f"/site/test/computers/{result['pc_name']}/")
+        self.assertEqual(result["user_url"], "/site/test/users/user/")
+
+        self.assertEqual(self.client.get(url).json()["count"], 5)
+        self.script.run_on(self.site, self.pcs, "value", user=superuser)
+        self.script.run_on(self.site, self.pcs, "value", user=None)
+        # Page numbers use the exact count, as the pages are limited to it
+        with self.assertNumQueries(query_count):
+            response = self.client.get(url, {"page": 1})
+        self.assertEqual(response.json()["count"], 15)
+        self.assertEqual(len(response.json()["results"]), 15)
+        # Otherwise the count is only shown, and cached
+        response = self.client.get(url).json()
+        self.assertEqual((response["count"], len(response["results"])), (5, 15))
+        self.assertIn("next_cursor", response)
+
+    def test_job_search_keyset_pagination(self):
+        superuser = User.objects.create_superuser("admin", "admin@example.com", "x")
+        UserProfile.objects.create(user=superuser)
+        self.client.force_login(superuser)
+        url = reverse("jobsearch", args=[self.site.uid])
+        for _ in range(9):
+            self.script.run_on(self.site, self.pcs, "value", user=None)
+        # Ties and NULLs in the ordering column
+        for job in Job.objects.all():
+            job.started = (
+                None if job.pk % 4 == 0 else datetime(2024, 1, 1, 12, job.pk % 4)
+            )
+            job.save()
+
+        for orderby in ["-started", "started", "-pk", "pc__name"]:
+            expected = [
+                result["pk"]
+                for page in (1, 2, 3)
+                for result in self.client.get(
+                    url, {"orderby": orderby, "page": page}
+                ).json()["results"]
+            ]
+            self.assertEqual(len(expected), 45)
+
+            data = self.client.get(url, {"orderby": orderby, "cursor": ""}).json()
+            pages = [data]
+            while data["has_next"]:
+                data = self.client.get(
+                    url, {"orderby": orderby, "cursor": data["next_cursor"]}
+                ).json()
+                pages.append(data)
+            self.assertEqual([page["page"] for page in pages], [1, 2, 3])
+            self.assertEqual(
+                [result["pk"] for page in pages for result in page["results"]],
+                expected,
+            )
+            self.assertEqual(pages[0]["count"], 45)
+
+            data = self.client.get(
+                url, {"orderby": orderby, "cursor": data["previous_cursor"]}
+            ).json()
+            self.assertEqual(data["results"], pages[1]["results"])
+            self.assertTrue(data["has_previous"])
+            self.assertTrue(data["has_next"])
+
+    def test_claim_jobs(self):
+        pc = self.pcs[0]
+        for value in ["a", "b"]:
+            self.script.run_on(self.site, [pc], value, user=None)
+
+        # Savepoint, lock, update, release, jobs and parameters
+        with self.assertNumQueries(6):
+            instructions = rpc.claim_jobs(pc)
+        self.assertEqual(
+            [instruction["parameters"] for instruction in instructions],
+            [[{"type": "STRING", "value": "a"}], [{"type": "STRING", "value": "b"}]],
+        )
+        self.assertEqual(instructions[0]["status"], Job.SUBMITTED)
+        self.assertEqual(rpc.claim_jobs(pc), [])
+
+    def test_send_status_info_updates_jobs_in_bulk(self):
+        pc, other_pc = self.pcs[0], self.pcs[1]
+        # Seen just now, so the check-in doesn't write last_seen
+        PC.objects.filter(pk=pc.pk).update(is_activated=True, last_seen=datetime.now())
+        batch = self.script.run_on(self.site, [pc, other_pc], "a", user=None)
+        job, other_job = batch.jobs.order_by("pc__name")
+        job_data = [
+            {
+                "id": j.id,
+                "status": Job.DONE,
+                "started": "2024-01-01 12:00:00",
+                "finished": "",
+                "log_output": "done",
+            }
+            for j in (job, other_job)
+        ]
+
+        # PC, jobs and the update
+        with self.assertNumQueries(3):
+            rpc.send_status_info_v2(pc.uid, job_data)
+
+        job.refresh_from_db()
+        other_job.refresh_from_db()
+        self.assertEqual((job.status, job.log_output), (Job.DONE, "done"))
+        self.assertIsNotNone(job.started)
+        self.assertIsNone(job.finished)
+        self.assertEqual(other_job.status, Job.NEW)
+
+
+class SecurityEventTest(TestCase):
+    def setUp(self):
+        self.site = Site.objects.create(name="Test", uid="test")
+        self.pcs = [
+            PC.objects.create(
+                name=f"pc{i}",
+                uid=f"pc{i}",
+                site=self.site,
+                configuration=Configuration.objects.create(name=f"pc{i}"),
+            )
+            for i in range(2)
+        ]
+        self.supervisor = User.objects.create(username="s", email="s@example.com")
+        self.alert_user = User.objects.create(username="a", email="a@example.com")
+        group = PCGroup.objects.create(name="group", site=self.site)
+        group.pcs.add(self.pcs[0])
+        group.supervisors.add(self.supervisor)
+        script = Script.objects.create(
+            name="script", site=self.site, executable_code="script.sh"
+        )
+        self.problems = [
+            SecurityProblem.objects.create(
+                name=f"problem{i}", site=self.site, security_script=script
+            )
+            for i in range(2)
+        ]
+        for problem in self.problems:
+            problem.alert_users.add(self.alert_user)
+
+    @override_settings(SERVER_EMAIL="server@example.com")
+    def test_push_security_events(self):
+        other_site = Site.objects.create(name="Other", uid="other")
+        other_problem = SecurityProblem.objects.create(
+            name="other",
+            site=other_site,
+            security_script=self.problems[0].security_script,
+        )
+        events = [
+            f"20240101120000,{self.problems[0].id},summary",
+            f"20240101120000,{other_problem.id},summary",
+            "20240101120000,invalid,summary",
+            f"2024-01-01 12:00,{self.problems[0].id},summary",
+            "invalid",
+        ]
+        rpc.push_security_events(self.pcs[0].uid, events)
+        self.assertEqual(
+            list(SecurityEvent.objects.values_list("problem", flat=True)),
+            [self.problems[0].id],
+        )
+        self.assertEqual(
+            list(Notification.objects.values_list("recipient", "status")),
+            [("s@example.com", Notification.PENDING)],
+        )
+
+    def test_notifications_are_digested_per_recipient(self):
+        events = [
+            SecurityEvent.objects.create(
+                problem=problem,
+                pc=pc,
+                occurred_time=datetime.now(),
+                reported_time=datetime.now(),
+                summary="summary",
+            )
+            for pc in self.pcs
+            for problem in self.problems
+        ]
+        notifications.notify_security_events(events[::2])
+        notifications.notify_security_events(events[1::2])
+        self.assertEqual(Notification.objects.count(), 4)
+
+        # Nothing is sent until the digest window has passed
+        self.assertEqual(notifications.dispatch_notifications(), 0)
+        later = datetime.now() + timedelta(minutes=1)
+        with self.assertNumQueries(4):
+            self.assertEqual(notifications.dispatch_notifications(later), 2)
+        self.assertEqual(
+            sorted(
+                (message.to, message.subject.split(" ")[0]) for message in mail.outbox
+            ),
+            [(["a@example.com"], "2"), (["s@example.com"], "2")],
+        )
+        self.assertFalse(
+            Notification.objects.exclude(status=Notification.SENT).exists()
+        )
+        self.assertEqual(notifications.dispatch_notifications(later), 0)
+
+    def test_event_search_name_ordering(self):
+        superuser = User.objects.create_superuser("admin", "admin@example.com", "x")
+        UserProfile.objects.create(user=superuser)
+        self.client.force_login(superuser)
+        rule = EventRuleServer.objects.create(
+            name="offline",
+            site=self.site,
+            monitor_period_start=time(0, 0),
+            monitor_period_end=time(23, 59, 59),
+        )
+        for pc in self.pcs:
+            for problem in [*self.problems, None]:
+                SecurityEvent.objects.create(
+                    problem=problem,
+                    event_rule_server=None if problem else rule,
+                    pc=pc,
+                    occurred_time=datetime.now(),
+                    reported_time=datetime.now(),
+                    summary="summary",
+                )
+        url = reverse("security_event_search", args=[self.site.uid])
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url, {"orderby": "-occurred_time"})
+        query_count = len(queries)
+        cache.clear()
+        with self.assertNumQueries(query_count):
+            response = self.client.get(url, {"orderby": "-name"})
+        self.assertEqual(
+            [result["problem_name"] for result in response.json()["results"]],
+            ["problem1", "problem1", "problem0", "problem0", "offline", "offline"],
+        )
+
+    def test_events_changed_since(self):
+        superuser = User.objects.create_superuser("admin", "admin@example.com", "x")
+        UserProfile.objects.create(user=superuser)
+        self.client.force_login(superuser)
+        APIKey.objects.create(key="secret", site=self.site)
+        start = datetime.now()
+        events = [
+            SecurityEvent.objects.create(
+                problem=problem,
+                pc=self.pcs[0],
+                occurred_time=start - timedelta(days=365),
+                reported_time=start,
+                summary="summary",
+            )
+            for problem in self.problems
+        ]
+
+        def sync(settle_period=0, **params):
+            with override_settings(SYNC_SETTLE_PERIOD=settle_period):
+                return self.client.get(
+                    "/api/system/events",
+                    {"limit": 1, **params},
+                    HTTP_AUTHORIZATION="Bearer secret",
+                ).json()
+
+        # Changes are only listed once they have had time to be committed
+        page = sync(settle_period=30, updated_since=start.isoformat())
+        self.assertEqual((page["items"], page["next_cursor"]), ([], None))
+        page = sync(updated_since=start.isoformat())
+        self.assertEqual([item["id"] for item in page["items"]], [events[0].pk])
+        page = sync(cursor=page["next_cursor"])
+        self.assertEqual([item["id"] for item in page["items"]], [events[1].pk])
+        cursor = page["next_cursor"]
+        self.assertEqual(sync(cursor=cursor)["items"], [])
+
+        # Bulk updates count as changes
+        self.client.post(
+            reverse("security_events_update", args=[self.site.uid]),
+            {"ids": [events[0].pk], "status": SecurityEvent.RESOLVED, "note": ""},
+        )
+        page = sync(cursor=cursor)
+        self.assertEqual(
+            [(item["id"], item["status"]) for item in page["items"]],
+            [(events[0].pk, SecurityEvent.RESOLVED)],
+        )
+
+    def test_offline_rules(self):
+        rule = EventRuleServer.objects.create(
+            name="offline",
+            site=self.site,
+            monitor_period_start=time(0, 0),
+            monitor_period_end=time(23, 59, 59),
+            maximum_offline_period=15,
+        )
+        rule.alert_users.add(self.alert_user)
+        now = datetime.combine(datetime.now().date(), time(12, 0))
+        PC.objects.filter(pk__in=[pc.pk for pc in self.pcs]).update(
+            last_seen=now - timedelta(hours=1)
+        )
+        rules = EventRuleServer.objects.prefetch_related("alert_groups")
+
+        self.assertEqual(
+            monitoring.check_offline_rules(rules, now),
+            {"rules": 1, "events": 2, "notifications": 2},
+        )
+        notifications.dispatch_notifications(datetime.now() + timedelta(minutes=1))
+        self.assertEqual(
+            sorted(
+                (message.to, message.body.split("\n")[1]) for message in mail.outbox
+            ),
+            [
+                (
+                    ["a@example.com"],
+                    "The computer(s) pc1 have been offline for longer than 15 minutes",
+                ),
+                (
+                    ["s@example.com"],
+                    "The computer(s) pc0 have been offline for longer than 15 minutes",
+                ),
+            ],
+        )
+        # Only one event per offline period
+        self.assertEqual(
+            monitoring.check_offline_rules(rules, now + timedelta(minutes=5))["events"],
+            0,
+        )
+
+    def test_offline_monitor(self):
+        rule = EventRuleServer.objects.create(
+            name="offline",
+            site=self.site,
+            monitor_period_start=time(0, 0),
+            monitor_period_end=time(23, 59, 59),
+            maximum_offline_period=15,
+        )
+        rule.alert_users.add(self.alert_user)
+        now = datetime.combine(datetime.now().date(), time(12, 0))
+        PC.objects.filter(pk__in=[pc.pk for pc in self.pcs]).update(
+            last_seen=now - timedelta(hours=1)
+        )
+        monitor = monitoring.OfflineMonitor()
+
+        stats = monitor.check(now)
+        self.assertEqual((stats["full_scan"], stats["events"]), (True, 2))
+
+        # pc1 comes back online and goes offline again
+        PC.objects.filter(pk=self.pcs[1].pk).update(
+            last_seen=now + timedelta(minutes=1)
+        )
+        # Rules, alert groups, and the savepoint, lock, offline PCs and
+        # release of the rule
+        with self.assertNumQueries(6):
+            stats = monitor.check(now + timedelta(minutes=10))
+        self.assertEqual((stats["full_scan"], stats["events"]), (False, 0))
+        stats = monitor.check(now + timedelta(minutes=17))
+        self.assertEqual((stats["full_scan"], stats["events"]), (False, 1))
+        self.assertEqual(
+            SecurityEvent.objects.filter(
+                pc=self.pcs[1], event_rule_server=rule
+            ).count(),
+            2,
+        )
+
+    def test_offline_monitor_uses_unwritten_heartbeats(self):
+        rule = EventRuleServer.objects.create(
+            name="offline",
+            site=self.site,
+            monitor_period_start=time(0, 0),
+            monitor_period_end=time(23, 59, 59),
+            maximum_offline_period=15,
+        )
+        rule.alert_users.add(self.alert_user)
+        now = datetime.combine(datetime.now().date(), time(12, 0))
+        PC.objects.filter(pk__in=[pc.pk for pc in self.pcs]).update(last_seen=now)
+        pc = PC.objects.get(pk=self.pcs[0].pk)
+        # The last check-in is only in the cache
+        self.assertFalse(heartbeat.record(pc, now + timedelta(seconds=50)))
+        monitor = monitoring.OfflineMonitor()
+
+        monitor.check(now + timedelta(minutes=15, seconds=20))
+        self.assertFalse(SecurityEvent.objects.filter(pc=pc).exists())
+        stats = monitor.check(now + timedelta(minutes=16))
+        self.assertFalse(stats["full_scan"])
+        self.assertTrue(SecurityEvent.objects.filter(pc=pc).exists())
+
+
+class APIAuthTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.site = Site.objects.create(name="Test", uid="test")
+        self.api_key = APIKey.objects.create(key="secret", site=self.site)
+        PC.objects.create(
+            name="pc",
+            uid="pc",
+            site=self.site,
+            configuration=Configuration.objects.create(name="pc"),
+        )
+
+    def get_computers(self, key="secret"):
+        return self.client.get(
+            "/api/system/computers", HTTP_AUTHORIZATION=f"Bearer {key}"
+        )
+
+    def test_site_is_cached_until_key_changes(self):
+        self.assertEqual(len(self.get_computers().json()), 1)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(len(self.get_computers().json()), 1)
+        self.assertFalse(
+            [query for query in queries if "system_apikey" in query["sql"]]
+        )
+        self.assertEqual(self.get_computers("wrong").status_code, 401)
+
+        self.api_key.key = "changed"
+        self.api_key.save()
+        self.assertEqual(self.get_computers().status_code, 401)
+        self.assertEqual(self.get_computers("changed").status_code, 200)
+
+        self.api_key.delete()
+        self.assertEqual(self.get_computers("changed").status_code, 401)
+
+        # Deleting keys in bulk or along with their site revokes them too
+        site = self.api_key.site
+        for delete in [
+            lambda: APIKey.objects.filter(site=site).delete(),
+            lambda: site.delete(),
+        ]:
+            APIKey.objects.create(key="other", site=site)
+            self.assertEqual(self.get_computers("other").status_code, 200)
+            delete()
+            self.assertEqual(self.get_computers("other").status_code, 401)
+
+    def test_logins_per_day(self):
+        pc = PC.objects.get()
+        pc.is_activated = True
+        pc.save()
+        rpc.push_config_keys(
+            pc.uid, {"login_counts": "2023-10-10: 4, 2023-10-11: 1, invalid"}
+        )
+        rpc.push_config_keys(pc.uid, {"login_counts": "2023-10-11: 2, 2023-10-12: 3"})
+        url = "/api/system/computers/logins-per-day"
+
+        # The API key and the logins
+        with self.assertNumQueries(2):
+            response = self.client.get(url, HTTP_AUTHORIZATION="Bearer secret")
+        self.assertEqual(
+            response.json(),
+            [{"pc_name": "pc", "logins_per_day": "2023-10-11: 2, 2023-10-12: 3"}],
+        )
+
+        # Values edited in the PC's configuration are stored as well
+        entry = pc.configuration.entries.get(key="login_counts")
+        params = QueryDict(mutable=True)
+        params.update(
+            {
+                "pc_config": str(entry.pk),
+                f"pc_config_{entry.pk}_key": "login_counts",
+                f"pc_config_{entry.pk}_value": "2023-10-12: 5",
+            }
+        )
+        pc.configuration.update_from_request(params, "pc_config")
+        self.assertEqual(
+            dict(pc.login_counts.values_list("date", "count")),
+            {date(2023, 10, 12): 5},
+        )
+        pc.configuration.update_from_request(QueryDict(), "pc_config")
+        self.assertFalse(pc.login_counts.exists())
+        rpc.push_config_keys(pc.uid, {"login_counts": "2023-10-11: 2, 2023-10-12: 3"})
+        response = self.client.get(
+            f"/api/system/computers/{pc.pk}/logins-per-day",
+            {"from_date": "2023-10-11", "to_date": "2023-10-11"},
+            HTTP_AUTHORIZATION="Bearer secret",
+        )
+        self.assertEqual(response.json()["logins_per_day"], "2023-10-11: 2")
+
+    @override_settings(SYNC_SETTLE_PERIOD=0)
+    def test_changed_computers(self):
+        url = "/api/system/computers/changes"
+        page = self.client.get(
+            url,
+            {"updated_since": "2000-01-01T00:00:00"},
+            HTTP_AUTHORIZATION="Bearer secret",
+        ).json()
+        self.assertEqual([item["name"] for item in page["items"]], ["pc"])
+        page = self.client.get(
+            url, {"cursor": page["next_cursor"]}, HTTP_AUTHORIZATION="Bearer secret"
+        ).json()
+        self.assertEqual(page["items"], [])
+
+        PC.objects.update(name="renamed", modified=datetime.now())
+        page = self.client.get(
+            url, {"cursor": page["next_cursor"]}, HTTP_AUTHORIZATION="Bearer secret"
+        ).json()
+        self.assertEqual([item["name"] for item in page["items"]], ["renamed"])
+
+    def test_logins_statistics(self):
+        pc = PC.objects.get()
+        pc.is_activated = True
+        pc.save()
+        group = PCGroup.objects.create(name="group", site=self.site)
+        pc.pc_groups.add(group)
+        rpc.push_config_keys(pc.uid, {"login_counts": "2023-10-10: 4, 2023-10-11: 1"})
+        LoginLog.objects.create(
+            identifier="citizen",
+            site=self.site,
+            date=date(2023, 10, 11),
+            login_time=time(12, 0),
+            logout_time=time(13, 0),
+        )
+        params = {"from_date": "2023-10-09", "to_date": "2023-10-11"}
+
+        def get_statistics():
+            return self.client.get(
+                "/api/system/logins/statistics",
+                params,
+                HTTP_AUTHORIZATION="Bearer secret",
+            ).json()
+
+        result = get_statistics()
+        self.assertEqual((result["logins"], result["citizen_logins"]), (5, 1))
+        self.assertEqual(
+            [(day["logins"], day["citizen_logins"]) for day in result["days"]],
+            [(0, 0), (4, 0), (1, 1)],
+        )
+        self.assertEqual(
+            result["groups"], [{"id": group.pk, "name": "group", "logins": 5}]
+        )
+
+        # The closed days are cached, leaving only the cache version and the
+        # groups to be fetched
+        with self.assertNumQueries(2):
+            get_statistics()
+
+        # Closed days reported late and changed group memberships are
+        # picked up
+        rpc.push_config_keys(
+            pc.uid, {"login_counts": "2023-10-09: 2, 2023-10-10: 4, 2023-10-11: 1"}
+        )
+        self.assertEqual(get_statistics()["logins"], 7)
+        other_group = PCGroup.objects.create(name="other", site=self.site)
+        pc.pc_groups.set([other_group])
+        self.assertEqual(
+            get_statistics()["groups"],
+            [
+                {"id": group.pk, "name": "group", "logins": 0},
+                {"id": other_group.pk, "name": "other", "logins": 7},
+            ],
+        )
+
+    def test_logins_statistics_are_invalidated_across_processes(self):
+        pc = PC.objects.get()
+        pc.is_activated = True
+        pc.save()
+        rpc.push_config_keys(pc.uid, {"login_counts": "2023-10-10: 4"})
+        params = {"from_date": "2023-10-09", "to_date": "2023-10-11"}
+
+        def get_logins(cache):
+            with mock.patch.object(login_statistics, "cache", cache):
+                return self.client.get(
+                    "/api/system/logins/statistics",
+                    params,
+                    HTTP_AUTHORIZATION="Bearer secret",
+                ).json()["logins"]
+
+        # Two processes, each with its own local memory cache
+        cache, other_cache = LocMemCache("one", {}), LocMemCache("other", {})
+        self.assertEqual(get_logins(cache), 4)
+        self.assertEqual(get_logins(other_cache), 4)
+
+        with mock.patch.object(login_statistics, "cache", cache):
+            rpc.push_config_keys(
+                pc.uid, {"login_counts": "2023-10-09: 2, 2023-10-10: 4"}
+            )
+        self.assertEqual(get_logins(other_cache), 6)
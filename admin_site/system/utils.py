@@ -4,57 +4,18 @@ import json
 import logging
 import re
 import requests
-import traceback
 from urllib.parse import quote
 from datetime import datetime
 
 from importlib import import_module
 
 from django.conf import settings
-from django.contrib.auth.models import User
-from django.core.mail import EmailMessage
+from django.urls import reverse
+from django.utils.http import RFC3986_SUBDELIMS
 from django.utils import translation
 from django.utils.translation import gettext_lazy as _
 
 
-def notify_users(security_event, security_problem, pc):
-    """Notify users about security event."""
-
-    logger = logging.getLogger(__name__)
-
-    # Subject = security name,
-    # Body = description + technical summary
-    email_list = []
-    supervisor_relations = pc.pc_groups.exclude(supervisors=None)
-    if supervisor_relations:
-        alert_users_pk = list(
-            set(supervisor_relations.values_list("supervisors", flat=True))
-        )
-        alert_users = User.objects.only("email").filter(pk__in=alert_users_pk)
-    else:
-        alert_users = security_problem.alert_users.only("email").all()
-    for user in alert_users:
-        email_list.append(user.email)
-
-    body = f"Beskrivelse af sikkerhedsadvarsel: {security_problem.description}\n"
-    body += f"Kort resume af data fra log filen : {security_event.summary}"
-    try:
-        message = EmailMessage(
-            f"Sikkerhedsadvarsel for PC : {pc.name}."
-            f" Sikkerhedsregel : {security_problem.name}",
-            body,
-            settings.DEFAULT_FROM_EMAIL,
-            email_list,
-        )
-        message.send(fail_silently=False)
-    except Exception:  # Likely Exception: SMTPException
-        logger.warning("Security Event e-mail-sending failed:")
-        logger.warning(traceback.format_exc())
-        return False
-
-    return True
-
-
 def get_citizen_login_api_validator():
     """Get the function used to validate library user login.
 
@@ -429,7 +390,16 @@ def notification_changes_saved(response, user_profile_language):
     return response
 
 
-def online_pcs_count_filter(pcs):
-    """Online PCs are PCs that have checked in recently, as defined by the model function
-    This function takes a list of PCs and returns the number of those that are online"""
-    return len([pc for pc in pcs if pc.online])
+def url_builder(viewname, args=()):
+    """Return a function that builds the URL of the view for a given value of
+    its last argument, the other arguments being fixed. The URL is only
+    reversed once, which matters when building URLs for many objects."""
+    placeholder = "0"
+    prefix, _, suffix = reverse(viewname, args=[*args, placeholder]).rpartition(
+        placeholder
+    )
+
+    def build(value):
+        return prefix + quote(str(value), safe=RFC3986_SUBDELIMS + "/~:@") + suffix
+
+    return build
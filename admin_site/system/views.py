@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
+import base64
+import binascii
+import datetime
 import os
 import json
 import secrets
@@ -24,8 +27,12 @@ from django.views.generic.list import BaseListView
 
 from django.db import transaction
 from django.db.models import Q, F
+from django.db.models.functions import Coalesce, Length
 
-from django.core.exceptions import PermissionDenied
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.core.paginator import Paginator
+from django.utils.functional import cached_property
 
 import django_otp
 from two_factor.forms import TOTPDeviceForm
@@ -40,8 +47,8 @@ from django.forms import Form
 from system.utils import (
     get_notification_string,
     notification_changes_saved,
-    online_pcs_count_filter,
     set_notification_cookie,
+    url_builder,
 )
 
 from account.models import (
@@ -70,6 +77,7 @@ from system.models import (
     EventRuleServer,
     EventLevels,
     Site,
+    SiteStatistics,
     Country,
 )
 
@@ -122,34 +130,14 @@ def otp_check(
 
 
 def site_pcs_stats(context, site_list):
-    context["borgerpc_count"] = PC.objects.filter(
-        site__in=site_list,
-        configuration__entries__key="os2_product",
-        configuration__entries__value="os2borgerpc",
-    ).count()
-    context["borgerpc_kiosk_count"] = PC.objects.filter(
-        site__in=site_list,
-        configuration__entries__key="os2_product",
-        configuration__entries__value="os2borgerpc kiosk",
-    ).count()
-    # Add counts for each _os_release
-    context["releases"] = []
-    for release in (
-        ConfigurationEntry.objects.filter(key="_os_release")
-        .order_by("value")
-        .distinct("value")
-        .values("value")
-    ):
-        context["releases"].append(
-            (
-                release["value"],
-                PC.objects.filter(
-                    site__in=site_list,
-                    configuration__entries__key="_os_release",
-                    configuration__entries__value=release["value"],
-                ).count(),
-            )
-        )
+    statistics = SiteStatistics.summarize(site.pk for site in site_list)
+    context["total_pcs_count"] = statistics["pc_count"]
+    context["activated_pcs_count"] = statistics["activated_pc_count"]
+    context["online_pcs_count"] = statistics["online_pc_count"]
+    context["borgerpc_count"] = statistics["borgerpc_count"]
+    context["borgerpc_kiosk_count"] = statistics["borgerpc_kiosk_count"]
+    # Counts for each _os_release
+    context["releases"] = statistics["releases"]
     return context
 
 
@@ -268,6 +256,200 @@ class JSONResponseMixin:
         return context
 
 
+class CachedCountPaginator(Paginator):
+    """A Paginator which caches the total count under the given key, as
+    counting is expensive for large tables."""
+
+    COUNT_CACHE_TIMEOUT = 60
+
+    def __init__(self, *args, count_cache_key=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.count_cache_key = count_cache_key
+
+    @cached_property
+    def count(self):
+        if self.count_cache_key is None:
+            return super().count
+        count = cache.get(self.count_cache_key)
+        if count is None:
+            count = super().count
+            cache.set(self.count_cache_key, count, self.COUNT_CACHE_TIMEOUT)
+        return count
+
+
+class KeysetPage:
+    """A page of results found by KeysetPaginationMixin."""
+
+    def __init__(self, object_list, number, has_next, has_previous):
+        self.object_list = object_list
+        self.number = number
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return self.number - 1
+
+    def get_cursor(self, obj, direction, number):
+        value = obj.keyset_value
+        if isinstance(value, (datetime.date, datetime.time)):
+            value = value.isoformat()
+        cursor = json.dumps([value, obj.pk, direction, number])
+        return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+    @property
+    def next_cursor(self):
+        if not self._has_next:
+            return None
+        return self.get_cursor(self.object_list[-1], "next", self.number + 1)
+
+    @property
+    def previous_cursor(self):
+        if not self._has_previous:
+            return None
+        return self.get_cursor(self.object_list[0], "previous", self.number - 1)
+
+
+class KeysetPaginationMixin:
+    """Mixin for JSON list views, adding keyset pagination.
+
+    The page is found by filtering on the ordering column and the primary
+    key of the last or first row of the previous page, given by the "cursor"
+    parameter, instead of by an OFFSET, so later pages are as fast as the
+    first. No or an empty cursor gives the first page, and next_cursor and
+    previous_cursor in the response give the adjacent pages. Requests with a
+    "page" parameter and no cursor use regular page numbers, for jumping to
+    a page.
+
+    The queryset must be ordered by a single column or annotation followed
+    by "pk". With a cursor, the total count is cached, as it's only shown
+    and not used to find the page. Page numbers always use the exact count,
+    as the Paginator limits the pages to it."""
+
+    def get_count_cache_key(self):
+        params = sorted(
+            (key, value)
+            for key, values in self.request.GET.lists()
+            for value in values
+            if key not in ("page", "cursor", "orderby")
+        )
+        # Superusers may see rows hidden from other users
+        scope = "all" if self.request.user.is_superuser else "visible"
+        return "search_count:{0}:{1}:{2}:{3}".format(
+            type(self).__name__, self.kwargs["slug"], scope, json.dumps(params)
+        )
+
+    @staticmethod
+    def after(field, value, descending):
+        """Return a Q object matching the rows with a value of field after
+        the given value, with PostgreSQL's default placement of NULLs: last
+        in ascending order and first in descending order."""
+        if value is None:
+            if descending:
+                return Q(**{f"{field}__isnull": False})
+            return Q(pk__in=[])
+        lookup = "lt" if descending else "gt"
+        condition = Q(**{f"{field}__{lookup}": value})
+        if not descending:
+            condition |= Q(**{f"{field}__isnull": True})
+        return condition
+
+    def paginate_queryset(self, queryset, page_size):
+        if "cursor" not in self.request.GET and "page" in self.request.GET:
+            return super().paginate_queryset(queryset, page_size)
+
+        paginator = CachedCountPaginator(
+            queryset, page_size, count_cache_key=self.get_count_cache_key()
+        )
+        order = queryset.query.order_by[0]
+        descending = order.startswith("-")
+        field = order.lstrip("-")
+        queryset = queryset.annotate(keyset_value=F(field))
+
+        if not self.request.GET.get("cursor"):
+            page_number, direction = 1, "next"
+            rows = list(queryset[: page_size + 1])
+        else:
+            try:
+                value, pk, direction, page_number = json.loads(
+                    base64.urlsafe_b64decode(self.request.GET["cursor"])
+                )
+            except (binascii.Error, TypeError, ValueError):
+                raise Http404(_("Invalid cursor"))
+            same = Q(**{f"{field}__isnull": True} if value is None else {field: value})
+            if direction == "next":
+                queryset = queryset.filter(
+                    self.after(field, value, descending) | same & Q(pk__gt=pk)
+                )
+            else:
+                # Walk backwards from the cursor, reversing the ordering
+                queryset = queryset.filter(
+                    self.after(field, value, not descending) | same & Q(pk__lt=pk)
+                ).order_by(
+                    (
+                        F(field).asc(nulls_last=True)
+                        if descending
+                        else F(field).desc(nulls_first=True)
+                    ),
+                    "-pk",
+                )
+            rows = list(queryset[: page_size + 1])
+
+        more = len(rows) > page_size
+        rows = rows[:page_size]
+        if direction == "next":
+            page = KeysetPage(rows, page_number, more, page_number > 1)
+        else:
+            page = KeysetPage(rows[::-1], page_number, True, more)
+        return (paginator, page, page.object_list, True)
+
+    def get_pagination_data(self, context):
+        page_obj = context["page_obj"]
+        paginator = context["paginator"]
+        num_pages = paginator.num_pages
+        adjacent_pages = 2
+        page_numbers = [
+            n
+            for n in range(
+                page_obj.number - adjacent_pages, page_obj.number + adjacent_pages + 1
+            )
+            if n > 0 and n <= num_pages
+        ]
+
+        data = {
+            "count": paginator.count,
+            "num_pages": num_pages,
+            "page": page_obj.number,
+            "page_numbers": page_numbers,
+            "has_next": page_obj.has_next(),
+            "next_page_number": (
+                page_obj.next_page_number() if page_obj.has_next() else None
+            ),
+            "has_previous": page_obj.has_previous(),
+            "previous_page_number": (
+                page_obj.previous_page_number() if page_obj.has_previous() else None
+            ),
+        }
+        if isinstance(page_obj, KeysetPage):
+            data["next_cursor"] = page_obj.next_cursor
+            data["previous_cursor"] = page_obj.previous_cursor
+        return data
+
+
 # Mixin class for CRUD views that use site_uid in URL
 # The "site_uid" slug is configurable, but please avoid clashes
 class SiteMixin(View):
@@ -331,13 +513,7 @@ class SiteList(ListView, LoginRequiredMixin):
 
     def get_context_data(self, **kwargs):
         context = super(SiteList, self).get_context_data(**kwargs)
-        context = site_pcs_stats(context, self.get_queryset())
-        total_pcs = PC.objects.filter(site__in=self.get_queryset())
-        context["total_pcs_count"] = len(total_pcs)
-        context["total_activated_pcs_count"] = total_pcs.filter(
-            is_activated=True
-        ).count()
-        context["total_online_pcs_count"] = online_pcs_count_filter(total_pcs)
+        context = site_pcs_stats(context, context["site_list"])
         context["user"] = self.request.user
         context["site_membership"] = (
             self.request.user.user_profile.sitemembership_set.order_by(
@@ -538,10 +714,6 @@ class SiteDetailView(SiteView):
             "is_activated", F("last_seen").desc(nulls_last=True)
         )
 
-        context["total_pcs_count"] = context["ls_pcs"].count()
-        context["activated_pcs_count"] = site_pcs.filter(is_activated=True).count()
-        context["online_pcs_count"] = online_pcs_count_filter(site_pcs)
-
         return context
 
 
@@ -570,7 +742,14 @@ class SiteSettings(UpdateView, SiteView):
             site = get_object_or_404(Site, uid=self.kwargs["slug"])
             form.instance.citizen_login_api_key = site.citizen_login_api_key
 
-        self.object.configuration.update_from_request(self.request.POST, "site_configs")
+        try:
+            self.object.configuration.update_from_request(
+                self.request.POST, "site_configs"
+            )
+        except ValidationError as e:
+            response = self.form_invalid(form)
+            set_notification_cookie(response, " ".join(e.messages), error=True)
+            return response
 
         response = super(SiteSettings, self).form_valid(form)
 
@@ -871,7 +1050,13 @@ class JobsView(SiteView):
         return context
 
 
-class JobSearch(SiteMixin, JSONResponseMixin, BaseListView, SuperAdminOrThisSiteMixin):
+class JobSearch(
+    SiteMixin,
+    KeysetPaginationMixin,
+    JSONResponseMixin,
+    BaseListView,
+    SuperAdminOrThisSiteMixin,
+):
     paginate_by = 20
     http_method_names = ["get"]
     VALID_ORDER_BY = []
@@ -925,7 +1110,24 @@ class JobSearch(SiteMixin, JSONResponseMixin, BaseListView, SuperAdminOrThisSite
         if orderby not in JobSearch.VALID_ORDER_BY:
             orderby = "-pk"
 
-        queryset = queryset.filter(**query).order_by(orderby, "pk")
+        queryset = (
+            queryset.filter(**query)
+            .select_related("batch__script", "pc", "user")
+            .only(
+                "status",
+                "created",
+                "started",
+                "finished",
+                "batch__name",
+                "batch__script__name",
+                "pc__name",
+                "pc__uid",
+                "user__username",
+                "user__is_superuser",
+            )
+            .annotate(log_output_length=Length("log_output"))
+            .order_by(orderby, "pk")
+        )
 
         return queryset
 
@@ -940,41 +1142,26 @@ class JobSearch(SiteMixin, JSONResponseMixin, BaseListView, SuperAdminOrThisSite
         else:
             return ""
 
-    def get_user_url(self, user, uid):
+    def get_user_url(self, user, user_url, user_doc_url):
         if user:
             if user.is_superuser:
-                return reverse("doc", kwargs={"name": "jobs"})
+                return user_doc_url
             else:
-                return (reverse("user", args=[uid, user.username]),)
+                return user_url(user.username)
         else:
             return ""
 
     def get_data(self, context):
         site = context["site"]
         page_obj = context["page_obj"]
-        paginator = context["paginator"]
-        adjacent_pages = 2
-        page_numbers = [
-            n
-            for n in range(
-                page_obj.number - adjacent_pages, page_obj.number + adjacent_pages + 1
-            )
-            if n > 0 and n <= paginator.num_pages
-        ]
-
+        # Build the URLs from prefixes instead of reversing them for each job
+        user_doc_url = reverse("doc", kwargs={"name": "jobs"})
+        user_url = url_builder("user", [site.uid])
+        script_url = url_builder("script", [site.uid])
+        pc_url = url_builder("computer", [site.uid])
+        restart_url = url_builder("restart_job", [site.uid])
         page = {
-            "count": paginator.count,
-            "num_pages": paginator.num_pages,
-            "page": page_obj.number,
-            "page_numbers": page_numbers,
-            "has_next": page_obj.has_next(),
-            "next_page_number": (
-                page_obj.next_page_number() if page_obj.has_next() else None
-            ),
-            "has_previous": page_obj.has_previous(),
-            "previous_page_number": (
-                page_obj.previous_page_number() if page_obj.has_previous() else None
-            ),
+            **self.get_pagination_data(context),
             "results": [
                 {
                     "pk": job.pk,
@@ -999,13 +1186,11 @@ class JobSearch(SiteMixin, JSONResponseMixin, BaseListView, SuperAdminOrThisSite
                     "pc_name": job.pc.name,
                     "batch_name": job.batch.name,
                     "user": self.get_username(job.user),
-                    "user_url": self.get_user_url(job.user, site.uid),
-                    "has_info": job.has_info,
-                    "script_url": reverse(
-                        "script", args=[site.uid, job.batch.script.id]
-                    ),
-                    "pc_url": reverse("computer", args=[site.uid, job.pc.uid]),
-                    "restart_url": reverse("restart_job", args=[site.uid, job.pk]),
+                    "user_url": self.get_user_url(job.user, user_url, user_doc_url),
+                    "has_info": (job.status == Job.FAILED or job.log_output_length > 1),
+                    "script_url": script_url(job.batch.script_id),
+                    "pc_url": pc_url(job.pc.uid),
+                    "restart_url": restart_url(job.pk),
                 }
                 for job in page_obj
             ],
@@ -1669,6 +1854,13 @@ class PCUpdate(SiteMixin, UpdateView, SuperAdminOrThisSiteMixin):
 
     def form_valid(self, form):
         pc = self.object
+        try:
+            # Before any scripts are run below
+            pc.configuration.parse_request(self.request.POST, "pc_config")
+        except ValidationError as e:
+            response = self.form_invalid(form)
+            set_notification_cookie(response, " ".join(e.messages), error=True)
+            return response
         groups_pre = pc.pc_groups.all()
 
         selected_groups = form.cleaned_data["pc_groups"]
@@ -3065,10 +3257,12 @@ class ConfigurationEntryCreate(SiteMixin, CreateView, SuperAdminOrThisSiteMixin)
 
     def form_valid(self, form):
         site = get_object_or_404(Site, uid=self.kwargs["slug"])
-        self.object = form.save(commit=False)
-        self.object.owner_configuration = site.configuration
+        # Overwrite the value if the key already exists
+        site.configuration.update_entry(
+            form.cleaned_data["key"], form.cleaned_data["value"]
+        )
 
-        return super(ConfigurationEntryCreate, self).form_valid(form)
+        return HttpResponseRedirect(self.get_success_url())
 
     def get_success_url(self):
         return reverse("settings", kwargs={"slug": self.kwargs["slug"]})
@@ -3349,6 +3543,10 @@ class PCGroupUpdate(SiteMixin, SuperAdminOrThisSiteMixin, UpdateView):
                     )
 
                 return response
+        except ValidationError as e:
+            response = self.form_invalid(form)
+            set_notification_cookie(response, " ".join(e.messages), error=True)
+            return response
         except MandatoryParameterMissingError as e:
             # If this happens, it happens *before* we have a valid
             # HttpResponse, so make one with form_invalid()
@@ -3670,7 +3868,9 @@ class SecurityEventsView(SiteView):
         return context
 
 
-class SecurityEventSearch(SiteMixin, JSONResponseMixin, BaseListView):
+class SecurityEventSearch(
+    SiteMixin, KeysetPaginationMixin, JSONResponseMixin, BaseListView
+):
     paginate_by = 20
     http_method_names = ["get"]
     VALID_ORDER_BY = []
@@ -3698,44 +3898,30 @@ class SecurityEventSearch(SiteMixin, JSONResponseMixin, BaseListView):
             queryset = queryset.filter(status__in=params.getlist("status"))
 
         orderby = params.get("orderby", "-occurred_time")
-        if orderby == "name":
-            queryset = sorted(queryset, key=lambda t: t.namestr)
-        elif orderby == "-name":
-            queryset = sorted(queryset, key=lambda t: t.namestr, reverse=True)
-        else:
-            if orderby not in SecurityEventSearch.VALID_ORDER_BY:
-                orderby = "-occurred_time"
+        if orderby in ("name", "-name"):
+            # Events belong to either a security problem or an event rule
+            queryset = queryset.annotate(
+                rule_name=Coalesce("problem__name", "event_rule_server__name")
+            )
+            orderby = orderby.replace("name", "rule_name")
+        elif orderby not in SecurityEventSearch.VALID_ORDER_BY:
+            orderby = "-occurred_time"
 
-            queryset = queryset.order_by(orderby, "pk")
+        queryset = queryset.select_related(
+            "problem", "event_rule_server", "pc", "assigned_user"
+        ).order_by(orderby, "pk")
 
         return queryset
 
     def get_data(self, context):
         site = context["site"]
         page_obj = context["page_obj"]
-        paginator = context["paginator"]
-        adjacent_pages = 2
-        page_numbers = [
-            n
-            for n in range(
-                page_obj.number - adjacent_pages, page_obj.number + adjacent_pages + 1
-            )
-            if n > 0 and n <= paginator.num_pages
-        ]
-
+        problem_url = url_builder("event_rule_security_problem", [site.uid])
+        event_rule_server_url = url_builder("event_rule_server", [site.uid])
+        pc_url = url_builder("computer", [site.uid])
+        user_url = url_builder("user", [site.uid])
         result = {
-            "count": paginator.count,
-            "num_pages": paginator.num_pages,
-            "page": page_obj.number,
-            "page_numbers": page_numbers,
-            "has_next": page_obj.has_next(),
-            "next_page_number": (
-                page_obj.next_page_number() if page_obj.has_next() else None
-            ),
-            "has_previous": page_obj.has_previous(),
-            "previous_page_number": (
-                page_obj.previous_page_number() if page_obj.has_previous() else None
-            ),
+            **self.get_pagination_data(context),
             "results": [
                 {
                     "pk": event.pk,
@@ -3746,15 +3932,9 @@ class SecurityEventSearch(SiteMixin, JSONResponseMixin, BaseListView):
                         else event.event_rule_server.name
                     ),
                     "problem_url": (
-                        reverse(
-                            "event_rule_security_problem",
-                            args=[site.uid, event.problem.id],
-                        )
+                        problem_url(event.problem_id)
                         if event.problem
-                        else reverse(
-                            "event_rule_server",
-                            args=[site.uid, event.event_rule_server.id],
-                        )
+                        else event_rule_server_url(event.event_rule_server_id)
                     ),
                     "pc_id": event.pc.id,
                     "occurred": event.occurred_time.strftime("%Y-%m-%d %H:%M:%S"),
@@ -3777,12 +3957,12 @@ class SecurityEventSearch(SiteMixin, JSONResponseMixin, BaseListView):
                     ]
                     + "",
                     "pc_name": event.pc.name,
-                    "pc_url": reverse("computer", args=[site.uid, event.pc.uid]),
+                    "pc_url": pc_url(event.pc.uid),
                     "assigned_user": (
                         event.assigned_user.username if event.assigned_user else ""
                     ),
                     "assigned_user_url": (
-                        reverse("user", args=[site.uid, event.assigned_user.username])
+                        user_url(event.assigned_user.username)
                         if event.assigned_user
                         else ""
                     ),
@@ -3817,7 +3997,12 @@ class SecurityEventsUpdate(SiteMixin, SuperAdminOrThisSiteMixin, ListView):
         assigned_user = params.get("assigned_user")
         note = params.get("note")
 
-        queryset.update(status=status, assigned_user=assigned_user, note=note)
+        queryset.update(
+            status=status,
+            assigned_user=assigned_user,
+            note=note,
+            modified=datetime.datetime.now(),
+        )
 
         return HttpResponse("OK")
 